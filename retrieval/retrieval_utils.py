@@ -7,20 +7,27 @@ import faiss
 from tqdm import tqdm
 import pandas as pd
 import tiktoken
-import pyterrier as pt
-from cord19_plus.data_model.embeddings import Embedding, Base
+from cord19_plus.data_model.embeddings import Embedding, CompactEmbedding, Base
 from cord19_plus.data_model.database_setup import setup_engine_session_alt
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, insert
 from dotenv import dotenv_values
 
 db_vals = dotenv_values("/workspaces/CORD19_Plus/.env")
 
 
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
-from collections import defaultdict
 import os
+import io
+import asyncio
+import hashlib
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
 
 tiktoken_cache_dir = "/workspaces/CORD19_Plus/retrieval/tiktoken_cache"
 os.environ["TIKTOKEN_CACHE_DIR"] = tiktoken_cache_dir
@@ -36,16 +43,14 @@ def cosine_similarity(a, b):
     else:
         return 0
 
-def search_docs(df, query, qid, n=1000, pprint=True):
-   
-   df.loc[:,'score'] = df.loc[:,'abstract_emb'].apply(lambda x: np.dot(x, query))
-   res = df.sort_values('score', ascending=False).head(n)
-   res.loc[:,'qid'] = qid
-   return res
-
-def get_embedding(text, model="text-embedding-3-small"):
-   text = text.replace("\n", " ")
-   return client.embeddings.create(input = [text], model=model).data[0].embedding
+def search_docs(df, query, qid, n=1000, pprint=True, column="abstract_emb"):
+    matrix = emb_matrix(df, column)
+    scores = matrix @ np.asarray(query, dtype=np.float32)
+    D, I = top_k_from_scores(scores[None, :], n)
+    res = df.iloc[I[0]].copy()
+    res.loc[:, 'score'] = D[0]
+    res.loc[:, 'qid'] = qid
+    return res
 
 def transform_to_pt_res(df):
     df.loc[:, 'rank'] = list(range(len(df)))
@@ -58,51 +63,288 @@ def load_emb_df(paths = "/workspace/chunks_small_abstract/*"):
     df = pd.concat(chunks)
     return df
 
-def apply_queries(queries, df):
-    results = []
-    with tqdm(total = len(queries)) as pbar:
-        for i, query in enumerate(queries):
-            res = search_docs(df=df, query=query, qid=i+1)
-            res = transform_to_pt_res(res)
-            results.append(res)
-            pbar.update(1)    
-    res_df = pd.concat(results)
-    return res_df
-
-def build_faiss_index(df, column_to_index="emb", method="dot_product"):
-    xb  = np.array(df.loc[:, column_to_index].to_list())
+def apply_queries(queries, df, column="abstract_emb", n=1000):
+    scorer = DenseScorer(df, column_to_index=column)
+    return scorer.transform(queries, k=n)
+
+def emb_matrix(df, column_to_index="emb"):
+    """Stacks an embedding column into one contiguous float32 matrix of shape (rows, dim)."""
+    return np.ascontiguousarray(np.vstack(df.loc[:, column_to_index].to_numpy()), dtype=np.float32)
+
+def top_k_from_scores(scores, k):
+    """
+    Selects the k highest scores per row without sorting the full row.
+
+    Args:
+        scores (np.ndarray): Score matrix of shape (queries, docs).
+        k (int): Number of results to keep per query.
+
+    Returns:
+        tuple: (D, I) arrays of shape (queries, min(k, docs)) holding the scores and the column
+               indices, ordered by descending score like a FAISS search result.
+    """
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        I = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        I = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    D = np.take_along_axis(scores, I, axis=1)
+    order = np.argsort(-D, axis=1, kind="stable")
+    return np.take_along_axis(D, order, axis=1), np.take_along_axis(I, order, axis=1)
+
+def topk_to_pt_res(D, I, docnos, qids=None, as_arrow=False):
+    """
+    Builds a PyTerrier result frame (qid, docno, rank, score) from top-k score and index arrays.
+
+    The run is assembled column-wise in a single pass, so the cost does not depend on how many
+    columns the indexed frame has. Negative ids, which FAISS returns when a query has fewer than
+    k hits, are dropped.
+
+    Args:
+        D (np.ndarray): Scores of shape (queries, k).
+        I (np.ndarray): Row indices into `docnos` of shape (queries, k).
+        docnos (np.ndarray): Docno of every indexed row.
+        qids (list, optional): Query id of every query row. Defaults to 1..len(queries).
+        as_arrow (bool, optional): Return a `pyarrow.Table` instead of a DataFrame. Defaults to False.
+
+    Returns:
+        pd.DataFrame: Run with one row per (query, result), ranks starting at 0.
+    """
+    n_queries, k = I.shape
+    if qids is None:
+        qids = np.arange(1, n_queries + 1)
+    valid = I.ravel() >= 0
+    if valid.all():
+        valid = slice(None)
+    columns = {
+        'qid': np.repeat(np.asarray(qids), k)[valid],
+        'docno': np.asarray(docnos)[I.ravel()[valid]],
+        'rank': np.tile(np.arange(k), n_queries)[valid],
+        'score': D.ravel()[valid],
+    }
+    if as_arrow:
+        import pyarrow as pa
+
+        return pa.table(columns)
+    return pd.DataFrame(columns)
+
+class DenseScorer:
+    """
+    Brute-force dot product scorer over an in-memory embedding matrix.
+
+    Keeps the embeddings as one contiguous float32 matrix and scores a batch of queries with a
+    single matrix multiplication. `search` mirrors the FAISS `index.search` interface, so the
+    scorer can be used wherever a flat index is expected.
+
+    Args:
+        df (pd.DataFrame): Frame holding a `docno` column and the embedding column.
+        column_to_index (str, optional): Name of the embedding column. Defaults to "emb".
+        batch_size (int, optional): Number of queries scored per matrix multiplication. Bounds the
+                                    size of the intermediate (batch, docs) score matrix. Defaults to 64.
+    """
+
+    def __init__(self, df, column_to_index="emb", batch_size=64):
+        self.matrix = emb_matrix(df, column_to_index)
+        self.docnos = df.loc[:, 'docno'].to_numpy()
+        self.batch_size = batch_size
+
+    @property
+    def ntotal(self):
+        return self.matrix.shape[0]
+
+    def search(self, queries, k=1000):
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        D, I = [], []
+        for i in range(0, len(queries), self.batch_size):
+            scores = queries[i:i + self.batch_size] @ self.matrix.T
+            D_batch, I_batch = top_k_from_scores(scores, k)
+            D.append(D_batch)
+            I.append(I_batch)
+        return np.vstack(D), np.vstack(I)
+
+    def transform(self, queries, qids=None, k=1000):
+        D, I = self.search(queries, k)
+        return topk_to_pt_res(D, I, self.docnos, qids)
+
+def build_faiss_index(df, column_to_index="emb", method="dot_product", metric="dot_product", nlist=None,
+                      pq_m=64, pq_nbits=8, hnsw_m=32, ef_construction=200, nprobe=16, ef_search=128,
+                      train_size=100_000, seed=42):
+    """
+    Builds a FAISS index over an embedding column.
+
+    Args:
+        df (pd.DataFrame): Frame holding the embedding column.
+        column_to_index (str, optional): Name of the embedding column. Defaults to "emb".
+        method (str, optional): Index type. "dot_product" and "euclid" build exhaustive flat indexes,
+                                "ivf_flat", "ivf_pq" and "hnsw" build approximate indexes. Defaults to "dot_product".
+        metric (str, optional): "dot_product" or "euclid", used by the approximate index types.
+                                Defaults to "dot_product".
+        nlist (int, optional): Number of IVF cells. Defaults to 4 * sqrt(rows).
+        pq_m (int, optional): Number of PQ sub-quantizers, must divide the dimension. Defaults to 64.
+        pq_nbits (int, optional): Bits per PQ code. Defaults to 8.
+        hnsw_m (int, optional): Neighbours per HNSW node. Defaults to 32.
+        ef_construction (int, optional): HNSW candidate list size while building. Defaults to 200.
+        nprobe (int, optional): IVF cells visited per query. Defaults to 16.
+        ef_search (int, optional): HNSW candidate list size per query. Defaults to 128.
+        train_size (int, optional): Number of rows sampled to train IVF indexes. Defaults to 100000.
+        seed (int, optional): Seed for the training sample. Defaults to 42.
+
+    Returns:
+        faiss.Index: The populated index.
+    """
+    xb = emb_matrix(df, column_to_index)
     d = xb.shape[1]
-    index = None
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == "dot_product" else faiss.METRIC_L2
+
     if method == "dot_product":
         index = faiss.IndexFlatIP(d)
-        xb = xb.astype('float32')
-        index.add(xb)  
     elif method == "euclid":
         index = faiss.IndexFlatL2(d)
-        xb = xb.astype('float32')
-        index.add(xb) 
-    
+    elif method in ("ivf_flat", "ivf_pq"):
+        nlist = nlist or max(1, min(len(xb), int(4 * np.sqrt(len(xb)))))
+        quantizer = faiss.IndexFlatIP(d) if metric == "dot_product" else faiss.IndexFlatL2(d)
+        if method == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss_metric)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, pq_m, pq_nbits, faiss_metric)
+        rng = np.random.default_rng(seed)
+        sample = xb[rng.choice(len(xb), size=min(train_size, len(xb)), replace=False)]
+        index.train(sample)
+    elif method == "hnsw":
+        index = faiss.IndexHNSWFlat(d, hnsw_m, faiss_metric)
+        index.hnsw.efConstruction = ef_construction
+    else:
+        raise ValueError(f"Unknown index method '{method}'")
+
+    index.add(xb)
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+    return index
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    """Sets `nprobe` on IVF indexes and `efSearch` on HNSW indexes. Flat indexes are left untouched."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and nprobe is not None:
+        ivf.nprobe = nprobe
+    hnsw = getattr(faiss.downcast_index(index), 'hnsw', None)
+    if hnsw is not None and ef_search is not None:
+        hnsw.efSearch = ef_search
     return index
 
+def ann_recall_report(index, exact_index, queries, k=100, settings=None):
+    """
+    Compares an approximate index against an exhaustive one for several search settings.
+
+    Args:
+        index (faiss.Index): Approximate index built with `build_faiss_index`.
+        exact_index (faiss.Index): Flat index over the same rows, used as ground truth.
+        queries (np.ndarray): float32 query matrix.
+        k (int, optional): Cutoff for recall@k. Defaults to 100.
+        settings (list, optional): Keyword dicts for `set_search_params`, e.g. [{'nprobe': 8}].
+                                   Defaults to a sweep over nprobe or efSearch depending on the index type.
+
+    Returns:
+        pd.DataFrame: One row per setting with the setting, 'recall@k' and 'ms_per_query'.
+    """
+    if settings is None:
+        if faiss.try_extract_index_ivf(index) is not None:
+            settings = [{'nprobe': n} for n in (1, 4, 16, 64, 256)]
+        else:
+            settings = [{'ef_search': ef} for ef in (16, 64, 128, 256, 512)]
+
+    # the sweep changes the caller's index, restore its settings afterwards
+    ivf = faiss.try_extract_index_ivf(index)
+    hnsw = getattr(faiss.downcast_index(index), 'hnsw', None)
+    original = {
+        'nprobe': ivf.nprobe if ivf is not None else None,
+        'ef_search': hnsw.efSearch if hnsw is not None else None,
+    }
+
+    _, I_exact = exact_index.search(queries, k)
+    report = []
+    try:
+        for params in settings:
+            set_search_params(index, **params)
+            start = time.perf_counter()
+            _, I = index.search(queries, k)
+            elapsed = time.perf_counter() - start
+            hits = [len(np.intersect1d(I[i][I[i] >= 0], I_exact[i])) for i in range(len(queries))]
+            report.append({
+                **params,
+                f'recall@{k}': np.sum(hits) / I_exact.size,
+                'ms_per_query': 1000 * elapsed / len(queries),
+            })
+    finally:
+        set_search_params(index, **original)
+    return pd.DataFrame(report)
+
+def save_index(index, docnos, path):
+    """
+    Writes a FAISS index and its docno sidecar to a directory.
+
+    Args:
+        index (faiss.Index): Index built with `build_faiss_index`.
+        docnos (array-like): Docno of every indexed row, in insertion order.
+        path (str): Target directory. Holds `index.faiss` and `docnos.npy` afterwards.
+
+    The retrieval API reads this layout with its own copy of `load_index` (retrieval_api/app/dense.py),
+    update `load_index` and `load_dense_index` together with any change to it.
+    """
+    os.makedirs(path, exist_ok=True)
+    faiss.write_index(index, os.path.join(path, "index.faiss"))
+    np.save(os.path.join(path, "docnos.npy"), np.asarray(docnos, dtype=str))
+
+def load_index(path, mmap=True):
+    """
+    Loads an index written by `save_index`.
+
+    With `mmap` the index data and the docnos are memory-mapped read-only, so loading is nearly free and
+    several processes serving the same index share one copy through the page cache.
+
+    Args:
+        path (str): Directory written by `save_index`.
+        mmap (bool, optional): Memory-map instead of reading into memory. Defaults to True.
+
+    Returns:
+        tuple: (index, docnos)
+    """
+    index_path = os.path.join(path, "index.faiss")
+    if mmap:
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        try:
+            index = faiss.read_index(index_path, flags | getattr(faiss, "IO_FLAG_MMAP_IFC", 0))
+        except RuntimeError:
+            # IVF inverted lists only support IO_FLAG_MMAP
+            index = faiss.read_index(index_path, flags)
+    else:
+        index = faiss.read_index(index_path)
+    docnos = np.load(os.path.join(path, "docnos.npy"), mmap_mode="r" if mmap else None)
+    return index, docnos
+
 def search(index, queries, k=1000):
     D, I = index.search(queries, k)
     return D, I
 
-def faiss_to_pt_res(I, D, df):
-    res = []
-    for i in range(I.shape[0]):
-        qid_res = pd.DataFrame()
-        qid_res = df.iloc[I[i]].copy()
-        qid_res.loc[:, 'qid'] = i + 1
-        qid_res.loc[:, 'rank'] = list(range(len(qid_res)))
-        qid_res.loc[:, 'score'] = list(D[i])
-        res.append(qid_res)
-    res = pd.concat(res)
-    return res
+def faiss_to_pt_res(I, D, df, qids=None, as_arrow=False):
+    """
+    Turns a FAISS search result into a PyTerrier run.
+
+    Args:
+        I (np.ndarray): Row ids returned by `index.search`.
+        D (np.ndarray): Scores returned by `index.search`.
+        df (pd.DataFrame or np.ndarray): Indexed frame with a 'docno' column, or the docno array
+                                         returned by `load_index`.
+        qids (list, optional): Query id of every query row. Defaults to 1..len(queries).
+        as_arrow (bool, optional): Return a `pyarrow.Table` instead of a DataFrame. Defaults to False.
+
+    Returns:
+        pd.DataFrame: Run with the columns qid, docno, rank and score.
+    """
+    docnos = df.loc[:, 'docno'].to_numpy() if isinstance(df, pd.DataFrame) else df
+    return topk_to_pt_res(D, I, docnos, qids=qids, as_arrow=as_arrow)
 
-def faiss_search_pipe(index, queries, df):
-    D, I = search(index, queries)
-    return faiss_to_pt_res(I, D, df)
+def faiss_search_pipe(index, queries, df, k=1000, qids=None, as_arrow=False):
+    D, I = search(index, queries, k)
+    return faiss_to_pt_res(I, D, df, qids=qids, as_arrow=as_arrow)
 
 def apply_cutoff(res, cutoff=20):
     return res[res['rank'] < cutoff]
@@ -126,29 +368,405 @@ def transform_to_catch_all(entry):
     
     return catch_all
 
+@lru_cache(maxsize=None)
+def get_encoder(encoding_name="cl100k_base"):
+    """Returns the tiktoken encoding, loaded once per process."""
+    return tiktoken.get_encoding(encoding_name)
+
 def num_tokens_from_string(string: str, encoding_name: str) -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return len(get_encoder(encoding_name).encode(string))
+
+EMBEDDING_CACHE_PATH = "/workspaces/CORD19_Plus/retrieval/embedding_cache.sqlite"
+
+def normalize_text(text):
+    """Collapses all whitespace, so texts that only differ in line breaks or spacing share a cache key."""
+    return " ".join(text.split())
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding store keyed by model name and the SHA-256 of the normalized text.
+
+    Vectors are kept as float16 or float32 blobs in a SQLite file, fronted by a bounded in-memory LRU,
+    so re-embedding text that was already embedded, e.g. after a docno or pipeline change, is free.
+
+    Args:
+        path (str, optional): SQLite file, created on first use. Defaults to EMBEDDING_CACHE_PATH.
+        dtype (str, optional): "float32" or "float16" storage precision. Defaults to "float32".
+        max_memory_items (int, optional): Capacity of the in-memory LRU. Defaults to 100000.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, dtype="float32", max_memory_items=100_000):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.max_memory_items = max_memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache "
+            "(model TEXT NOT NULL, key TEXT NOT NULL, dtype TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model, key))"
+        )
+        self._conn.commit()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+    def _remember(self, model, key, vector):
+        self._memory[(model, key)] = vector
+        self._memory.move_to_end((model, key))
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, model, keys):
+        """Returns the cached vector (as list) for every key, None where the key is not cached."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get((model, key))
+                if vector is not None:
+                    self._memory.move_to_end((model, key))
+                    found[key] = vector
+                    self.memory_hits += 1
+
+            missing = list({key for key in keys if key not in found})
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, dtype, vector FROM embedding_cache WHERE model = ? AND key IN "
+                    f"({','.join('?' * len(chunk))})",
+                    [model, *chunk],
+                ).fetchall()
+                for key, dtype, blob in rows:
+                    vector = np.frombuffer(blob, dtype=dtype)
+                    found[key] = vector
+                    self._remember(model, key, vector)
+                    self.disk_hits += 1
+            self.misses += sum(key not in found for key in keys)
+
+        return [found[key].astype(np.float32).tolist() if key in found else None for key in keys]
+
+    def put_many(self, model, keys, vectors):
+        """Stores vectors under their keys, skipping None vectors."""
+        rows = []
+        with self._lock:
+            for key, vector in zip(keys, vectors):
+                if vector is None:
+                    continue
+                vector = np.asarray(vector, dtype=self.dtype)
+                self._remember(model, key, vector)
+                rows.append((model, key, self.dtype.name, vector.tobytes()))
+            self._conn.executemany("INSERT OR REPLACE INTO embedding_cache VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def stats(self):
+        """Returns hit and miss counters and the overall hit rate since the cache was opened."""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        self._conn.close()
+
+class RateLimiter:
+    """
+    Thread-safe token bucket limiting requests and tokens per minute.
+
+    Args:
+        requests_per_minute (int, optional): Request budget per minute. Defaults to 3000.
+        tokens_per_minute (int, optional): Token budget per minute. Defaults to 1000000.
+    """
+
+    def __init__(self, requests_per_minute=3000, tokens_per_minute=1_000_000):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self._last = now - self._last, now
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+
+    def acquire(self, tokens=0):
+        """Blocks until one request with `tokens` tokens fits into the budget."""
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                wait = max((1 - self._requests) * 60 / self.requests_per_minute,
+                           (tokens - self._tokens) * 60 / self.tokens_per_minute)
+            time.sleep(max(wait, 0.001))
+
+class EmbeddingClient:
+    """
+    Batched client for the OpenAI embeddings endpoint.
+
+    Every text is tokenized once with a cached encoder and truncated to the model's input limit by tokens.
+    The token arrays are then packed into as few requests as the per-request input and token limits allow.
+    Failed requests are retried with exponential backoff.
+
+    Args:
+        model (str, optional): Embedding model. Defaults to "text-embedding-3-small".
+        client (optional): Object exposing `embeddings.create(input=..., model=...)` like `openai.OpenAI`.
+                           Pass a stub to run without the API. Defaults to the module-level OpenAI client.
+        encoding_name (str, optional): tiktoken encoding of the model. Defaults to "cl100k_base".
+        max_tokens (int, optional): Maximum tokens per input. Defaults to 8191.
+        max_batch_size (int, optional): Maximum inputs per request. Defaults to 2048.
+        max_batch_tokens (int, optional): Maximum tokens per request. Defaults to 300000.
+        max_retries (int, optional): Attempts per request before the error is raised. Defaults to 6.
+        backoff (float, optional): Initial retry delay in seconds, doubled after every failure. Defaults to 1.0.
+        cache (EmbeddingCache, optional): Cache consulted before and filled after every request. Defaults to None.
+        rate_limiter (RateLimiter, optional): Budget every request is charged against. Defaults to None.
+    """
+
+    def __init__(self, model="text-embedding-3-small", client=None, encoding_name="cl100k_base", max_tokens=8191,
+                 max_batch_size=2048, max_batch_tokens=300_000, max_retries=6, backoff=1.0, cache=None,
+                 rate_limiter=None):
+        self.model = model
+        self.client = client if client is not None else globals()['client']
+        self.encoding_name = encoding_name
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.n_requests = 0
+
+    def tokenize(self, text):
+        """Returns the truncated token array of a text or None if the text is too short to embed."""
+        if text is None or len(text) <= 3:
+            return None
+        tokens = get_encoder(self.encoding_name).encode(text.replace("\n", " "))
+        return tokens[:self.max_tokens]
+
+    def pack(self, token_lists):
+        """Yields lists of positions in `token_lists` that fit into one request each."""
+        batch, batch_tokens = [], 0
+        for i, tokens in enumerate(token_lists):
+            if tokens is None:
+                continue
+            if batch and (len(batch) >= self.max_batch_size or batch_tokens + len(tokens) > self.max_batch_tokens):
+                yield batch
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += len(tokens)
+        if batch:
+            yield batch
+
+    def request(self, inputs):
+        """Sends one embeddings request, retrying with exponential backoff."""
+        for attempt in range(self.max_retries):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(tokens=sum(len(tokens) for tokens in inputs))
+            try:
+                self.n_requests += 1
+                response = self.client.embeddings.create(input=inputs, model=self.model)
+                return [row.embedding for row in sorted(response.data, key=lambda row: row.index)]
+            except Exception as e:
+                if attempt == self.max_retries - 1:
+                    raise
+                delay = self.backoff * 2**attempt * (1 + random.random())
+                print(f"Embedding request failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def embed(self, texts):
+        """
+        Embeds a list of texts.
+
+        Args:
+            texts (list): Texts to embed.
+
+        Returns:
+            list: One embedding per text, None for texts that are too short to embed.
+        """
+        embeddings = [None] * len(texts)
+        todo = list(range(len(texts)))
+        if self.cache is not None:
+            keys = [EmbeddingCache.key(text) if text is not None and len(text) > 3 else None for text in texts]
+            todo = [i for i in todo if keys[i] is not None]
+            for i, emb in zip(todo, self.cache.get_many(self.model, [keys[i] for i in todo])):
+                embeddings[i] = emb
+            todo = [i for i in todo if embeddings[i] is None]
+
+        token_lists = [self.tokenize(texts[i]) for i in todo]
+        for batch in self.pack(token_lists):
+            batch_embs = self.request([token_lists[j] for j in batch])
+            for j, emb in zip(batch, batch_embs):
+                embeddings[todo[j]] = emb
+            if self.cache is not None:
+                self.cache.put_many(self.model, [keys[todo[j]] for j in batch], batch_embs)
+        return embeddings
+
+@lru_cache(maxsize=None)
+def get_embedding_cache(path=EMBEDDING_CACHE_PATH):
+    """Returns the shared `EmbeddingCache` stored at `path`."""
+    return EmbeddingCache(path)
+
+@lru_cache(maxsize=None)
+def get_embedding_client(model="text-embedding-3-small", use_cache=True, requests_per_minute=3000,
+                         tokens_per_minute=1_000_000):
+    """
+    Returns the shared `EmbeddingClient` of a model, backed by the shared embedding cache.
+
+    Every request of the client is charged against one `RateLimiter`, so concurrent batches stay within the
+    account's request and token limits instead of running into 429 responses.
+    """
+    return EmbeddingClient(
+        model=model,
+        cache=get_embedding_cache() if use_cache else None,
+        rate_limiter=RateLimiter(requests_per_minute, tokens_per_minute),
+    )
 
 def get_embedding(text, model="text-embedding-3-small"):
-   if len(text)<=3:
-      return None
+    return get_embedding_client(model).embed([text])[0]
+
+TREC_RUN_COLUMNS = ['qid', 'Q0', 'docno', 'rank', 'score', 'name']
+
+def read_trec_run_chunks(file_path, chunksize=1_000_000):
+    """
+    Reads a TREC run file in chunks and drops invalid entries with vectorized masks.
+
+    Args:
+        file_path (str): Run file with lines in the format <qid> Q0 <docno> <rank> <score> <systemname>.
+        chunksize (int, optional): Number of lines parsed at once. Defaults to 1000000.
+
+    Yields:
+        pd.DataFrame: Chunks with the columns 'qid' (int), 'docno' (str), 'rank' (float) and 'score' (float).
+    """
+    reader = pd.read_csv(
+        file_path,
+        sep=r"\s+",
+        header=None,
+        names=TREC_RUN_COLUMNS,
+        usecols=['qid', 'docno', 'rank', 'score'],
+        dtype={'qid': str, 'docno': str},
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        qid = pd.to_numeric(chunk['qid'], errors='coerce')
+        rank = pd.to_numeric(chunk['rank'], errors='coerce')
+        valid = (qid % 1 == 0) & (rank >= 0)
+        n_invalid = int((~valid).sum())
+        if n_invalid:
+            print(f"Warning: Skipping {n_invalid} entries with invalid qid or rank in file '{file_path}'.")
+        yield pd.DataFrame({
+            'qid': qid[valid].astype(int),
+            'docno': chunk['docno'][valid],
+            'rank': rank[valid],
+            'score': pd.to_numeric(chunk['score'][valid], errors='coerce').fillna(0.0),
+        })
+
+def _run_contributions(run, method, k, weight):
+    """Per (qid, docno) contribution of a single run to the fused score."""
+    if method == "rrf":
+        score = weight / (run['rank'] + k)
+    elif method in ("combsum", "combmnz"):
+        # a run votes once per document, min-max normalised per topic so score ranges are comparable
+        run = run.sort_values('rank').drop_duplicates(['qid', 'docno'])
+        grouped = run.groupby('qid')['score']
+        low, high = grouped.transform('min'), grouped.transform('max')
+        score = weight * ((run['score'] - low) / (high - low).where(high > low, 1.0))
+    else:
+        raise ValueError(f"Unknown fusion method '{method}'")
+    return pd.DataFrame({'qid': run['qid'], 'docno': run['docno'], 'score': score, 'hits': 1})
+
+def _sum_contributions(parts):
+    # added part by part, groupby sums are compensated and would differ in the last bit from the per-pair
+    # loop this replaced, which flips the rounding of exact ties such as 5/60 + 1/96
+    pool = None
+    for part in parts:
+        part = part.groupby(['qid', 'docno'], sort=False)[['score', 'hits']].sum()
+        pool = part if pool is None else pool.add(part, fill_value=0)
+    pool = pool.reset_index()
+    pool['hits'] = pool['hits'].astype(int)
+    return pool
+
+def fuse_runs(root_path, method="rrf", k=60, weights=None, depth=None, round_decimals=4, chunksize=1_000_000,
+              merge_every=8):
+    """
+    Fuses all TREC run files in a directory into one ranking.
+
+    Runs are read chunk-wise, turned into per (qid, docno) contributions and summed with a groupby, so
+    memory is bounded by the fused pool rather than by the number of runs.
+
+    Args:
+        root_path (str): Directory containing the run files.
+        method (str, optional): "rrf" sums weight / (rank + k), "combsum" sums the per-topic min-max
+                                normalised scores and "combmnz" multiplies that sum by the number of runs
+                                that retrieved the document. Defaults to "rrf".
+        k (int, optional): Smoothing constant added to each rank for RRF. Defaults to 60.
+        weights (dict, optional): Weight per run, keyed by file name without extension. Runs not listed
+                                  get weight 1. Defaults to None.
+        depth (int, optional): Keep only the top `depth` documents per topic. Defaults to None (keep all).
+        round_decimals (int, optional): Decimal places of the fused scores, None disables rounding. Defaults to 4.
+        chunksize (int, optional): Number of lines read from a run file at once. Defaults to 1000000.
+        merge_every (int, optional): Number of per-run aggregates collected before they are merged. Defaults to 8.
+
+    Returns:
+        pd.DataFrame: Run with the columns 'qid' (int), 'docno', 'score' and 'rank' (starting at 0),
+                      sorted by 'qid' and descending 'score'.
+    """
+    weights = weights or {}
+    parts = []
+
+    # directory order like the loop this replaced, the summation order decides the last bit of the scores
+    for filename in os.listdir(root_path):
+        file_path = os.path.join(root_path, filename)
+        if not os.path.isfile(file_path):
+            continue
+        weight = weights.get(os.path.splitext(filename)[0], 1.0)
+
+        try:
+            chunks = read_trec_run_chunks(file_path, chunksize=chunksize)
+            if method == "rrf":
+                # collected per file first, a file failing halfway must not be fused partially
+                file_parts = [_run_contributions(chunk, method, k, weight) for chunk in chunks]
+            else:
+                # score normalisation needs every entry of a topic at once
+                file_parts = [_run_contributions(pd.concat(chunks), method, k, weight)]
+        except Exception as e:
+            print(f"Error reading file '{filename}': {e}")
+            continue
+        parts.extend(file_parts)
 
-   text = text.replace("\n", " ")
+        if len(parts) >= merge_every:
+            parts = [_sum_contributions(parts)]
 
-   if num_tokens_from_string(text, "cl100k_base") <= 8192:
-      return client.embeddings.create(input = [text], model=model).data[0].embedding
-   
-   else:
-      text = " ".join(text.split(" ")[:1900])
-      if num_tokens_from_string(text, "cl100k_base") <= 8192:
-         return client.embeddings.create(input = [text], model=model).data[0].embedding
-      else:
-         print(num_tokens_from_string(text, "cl100k_base"))
+    if not parts:
+        return pd.DataFrame({'qid': [], 'docno': [], 'score': [], 'rank': []})
 
-   return None
+    pool = _sum_contributions(parts)
+    if method == "combmnz":
+        pool['score'] *= pool['hits']
+    if round_decimals is not None:
+        # Python's round like the per-pair loop this replaced, Series.round turns e.g. 1/160 into 0.0062
+        pool['score'] = [round(score, round_decimals) for score in pool['score'].tolist()]
+
+    pool = pool.sort_values(by=['qid', 'score'], ascending=[True, False]).reset_index(drop=True)
+    pool['rank'] = pool.groupby('qid').cumcount()
+    if depth is not None:
+        pool = pool[pool['rank'] < depth].reset_index(drop=True)
+    return pool[['qid', 'docno', 'score', 'rank']]
 
 def generate_document_pool_rrf_df(root_path, k=60, round_decimals=4):
     """
@@ -169,119 +787,207 @@ def generate_document_pool_rrf_df(root_path, k=60, round_decimals=4):
                       - 'rrf_score': The Reciprocal Rank Fusion score of the document across all systems (float)
                       The DataFrame is sorted by 'qid' and 'rrf_score' in descending order.
     """
+    pool = fuse_runs(root_path, method="rrf", k=k, round_decimals=round_decimals)
+    return pool[['qid', 'docno', 'score']].rename(columns={'score': 'rrf_score'})
 
-    if not pt.started():
-        pt.init()
 
-    # Initialize a defaultdict to store all ranks for each (qid, docno) pair
-    rank_pool = defaultdict(list)
 
-    # Iterate over all files in the root directory
-    for filename in os.listdir(root_path):
-        file_path = os.path.join(root_path, filename)
 
-        # Check if the path is a file
-        if os.path.isfile(file_path):
-            try:
-                # Read the ranking results using PyTerrier
-                results = pt.io.read_results(file_path)
+def process_res(res):
+    catch_all = transform_to_catch_all(res)
+    return {'docno': res['docno'], 'emb': get_embedding(catch_all)}
 
-                # Ensure necessary columns are present
-                expected_columns = {'qid', 'docno', 'rank', 'score'}
-                if not expected_columns.issubset(results.columns):
-                    print(f"Warning: File '{filename}' is missing expected columns. Skipping.")
-                    continue
+def embed_results(results, embedding_client=None):
+    """Embeds the catch-all text of many table dicts with as few requests as possible."""
+    embedding_client = embedding_client or get_embedding_client()
+    embs = embedding_client.embed([transform_to_catch_all(res) for res in results])
+    return [{'docno': res['docno'], 'emb': emb} for res, emb in zip(results, embs)]
 
-                # Iterate through each row in the DataFrame
-                for _, row in results.iterrows():
-                    # Extract and validate qid
-                    qid_raw = row['qid']
-                    try:
-                        qid = int(qid_raw)
-                    except (ValueError, TypeError):
-                        print(f"Warning: Invalid qid '{qid_raw}' in file '{filename}'. Skipping this entry.")
-                        continue
-
-                    # Extract docno
-                    docno = str(row['docno'])
-
-                    # Extract and validate rank
-                    rank = row['rank']
-                    if pd.isna(rank):
-                        print(f"Warning: Missing rank for docno '{docno}' in qid '{qid}' in file '{filename}'. Skipping this entry.")
-                        continue
-
-                    try:
-                        rank = float(rank)
-                        if rank < 0:
-                            print(f"Warning: Negative rank '{rank}' for docno '{docno}' in qid '{qid}' in file '{filename}'. Skipping this entry.")                            
-                            continue
-                    except ValueError:
-                        print(f"Warning: Invalid rank '{rank}' for docno '{docno}' in qid '{qid}' in file '{filename}'. Skipping this entry.")
-                        continue
-
-                    # Append the rank to the list for this (qid, docno) pair
-                    rank_pool[(qid, docno)].append(rank)
+def embeddings_to_db(emb_list, session):
+    rows = [{'docno': dict_el['docno'], 'embedding': dict_el['emb']} for dict_el in emb_list]
+    if rows:
+        session.execute(insert(Embedding), rows)
+    session.commit()
 
-            except Exception as e:
-                print(f"Error reading file '{filename}': {e}")
+def _copy_escape(text):
+    return str(text).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
 
-    # Prepare data for the DataFrame
-    data = {
-        'qid': [],
-        'docno': [],
-        'rrf_score': []
-    }
+def copy_embeddings_to_db(emb_list, session, compact=False):
+    """
+    Writes embeddings with a single COPY instead of one INSERT per row.
 
-    for (qid, docno), ranks in rank_pool.items():
-        if ranks:
-            # Calculate RRF score: sum(1 / (rank + k)) for all ranks
-            rrf_score = sum(1.0 / (rank + k) for rank in ranks)
-            rrf_score = round(rrf_score, round_decimals)  # Round the RRF score
-            data['qid'].append(qid)
-            data['docno'].append(docno)
-            data['rrf_score'].append(rrf_score)
+    Docnos that are already stored are skipped, so a batch written again after a crash between the commit and the
+    checkpoint update does not add duplicate rows.
 
-    # Create the DataFrame
-    df_pool = pd.DataFrame(data)
+    Args:
+        emb_list (list): Dicts with 'docno' and 'emb'.
+        session (Session): Session of the embedding database.
+        compact (bool, optional): Write float32 bytes to `embedding_compact` instead of the double precision
+                                  `embedding` array table. Defaults to False.
+    """
+    buffer = io.StringIO()
+    for dict_el in emb_list:
+        docno = _copy_escape(dict_el['docno'])
+        if compact:
+            vector = np.asarray(dict_el['emb'], dtype='<f4')
+            buffer.write(f"{docno}\t{vector.shape[0]}\t\\\\x{vector.tobytes().hex()}\n")
+        else:
+            buffer.write(f"{docno}\t{{{','.join(map(repr, map(float, dict_el['emb'])))}}}\n")
+    if not buffer.tell():
+        return
+    buffer.seek(0)
 
-    # Sort the DataFrame by 'qid' ascending and 'rrf_score' descending
-    df_pool_sorted = df_pool.sort_values(by=['qid', 'rrf_score'], ascending=[True, False]).reset_index(drop=True)
+    try:
+        cursor = session.connection().connection.cursor()
+        # stage first, COPY itself cannot skip docnos that are already stored
+        if compact:
+            cursor.execute(
+                "CREATE TEMP TABLE embedding_stage (docno varchar(1024), dim integer, embedding bytea) ON COMMIT DROP"
+            )
+            cursor.copy_expert("COPY embedding_stage (docno, dim, embedding) FROM STDIN", buffer)
+            cursor.execute(
+                "INSERT INTO embedding_compact (docno, dim, embedding) "
+                "SELECT docno, dim, embedding FROM embedding_stage ON CONFLICT (docno) DO NOTHING"
+            )
+        else:
+            # `embedding` has no unique docno constraint, existing rows are skipped through its docno index
+            cursor.execute(
+                "CREATE TEMP TABLE embedding_stage (docno varchar(1024), embedding double precision[]) ON COMMIT DROP"
+            )
+            cursor.copy_expert("COPY embedding_stage (docno, embedding) FROM STDIN", buffer)
+            cursor.execute(
+                "INSERT INTO embedding (docno, embedding) "
+                "SELECT DISTINCT ON (s.docno) s.docno, s.embedding FROM embedding_stage s "
+                "WHERE NOT EXISTS (SELECT 1 FROM embedding e WHERE e.docno = s.docno)"
+            )
+        session.commit()
+    except Exception:
+        # the raw cursor bypasses the session, without a rollback every later batch fails on the aborted transaction
+        session.rollback()
+        raise
 
-    return df_pool_sorted
+def batch_iterator(iterable, batch_size):
+    """Generator to yield batches of specified size from the iterable."""
+    for i in range(0, len(iterable), batch_size):
+        yield iterable[i:i + batch_size]
 
+EMBEDDING_CHECKPOINT_PATH = "/workspaces/CORD19_Plus/retrieval/embedding_checkpoint.txt"
+# separate log for the compact table, docnos stored in `embedding` are not stored in `embedding_compact`
+EMBEDDING_COMPACT_CHECKPOINT_PATH = "/workspaces/CORD19_Plus/retrieval/embedding_checkpoint_compact.txt"
 
+class EmbeddingCheckpoint:
+    """
+    Append-only log of docnos whose embeddings are stored, used to resume an interrupted ingestion.
 
+    Args:
+        path (str): Checkpoint file, one docno per line.
+    """
 
-def process_res(res):
-    catch_all = transform_to_catch_all(res)
-    return {'docno': res['docno'], 'emb': get_embedding(catch_all)}
+    def __init__(self, path=EMBEDDING_CHECKPOINT_PATH):
+        self.path = path
 
-def embeddings_to_db(emb_list, session):
-    for dict_el in emb_list:
-        emb = Embedding(docno=dict_el['docno'], embedding=dict_el['emb'])
-        session.add(emb)
-    session.commit()
+    def exists(self):
+        return os.path.exists(self.path)
 
-def batch_iterator(iterable, batch_size):
-    """Generator to yield batches of specified size from the iterable."""
-    for i in range(0, len(iterable), batch_size):
-        yield iterable[i:i + batch_size]
+    def done(self):
+        """Returns the set of docnos recorded so far."""
+        if not self.exists():
+            return set()
+        with open(self.path, "r") as f:
+            return {line.rstrip("\n") for line in f if line.strip()}
+
+    def update(self, docnos):
+        """Records docnos once their embeddings are committed."""
+        with open(self.path, "a") as f:
+            f.writelines(f"{docno}\n" for docno in docnos)
+            f.flush()
+            os.fsync(f.fileno())
+
+async def embedding_pipeline(results, write_fn, embedding_client, batch_size=1000, max_concurrency=8,
+                             checkpoint=None, pbar=None):
+    """
+    Embeds table dicts and writes the vectors with reading, embedding and writing as concurrent stages.
+
+    Batches flow through bounded queues, so at most `max_concurrency` embedding requests are in flight and
+    memory stays bounded. Request and token rates are limited by the client's `RateLimiter`.
+
+    Args:
+        results (list): Table dicts with a 'docno' and the fields used by `transform_to_catch_all`.
+        write_fn (callable): Receives a list of {'docno', 'emb'} dicts and stores them.
+        embedding_client (EmbeddingClient): Client used for the embedding requests.
+        batch_size (int, optional): Table dicts per embedding batch. Defaults to 1000.
+        max_concurrency (int, optional): Number of batches embedded concurrently. Defaults to 8.
+        checkpoint (EmbeddingCheckpoint, optional): Receives the docnos of every written batch. Defaults to None.
+        pbar (tqdm, optional): Progress bar advanced once per written batch. Defaults to None.
+    """
+    embed_queue = asyncio.Queue(maxsize=2 * max_concurrency)
+    write_queue = asyncio.Queue(maxsize=2 * max_concurrency)
+
+    async def read():
+        for batch in batch_iterator(results, batch_size):
+            await embed_queue.put(batch)
+        for _ in range(max_concurrency):
+            await embed_queue.put(None)
+
+    async def embed():
+        while (batch := await embed_queue.get()) is not None:
+            try:
+                rows = await asyncio.to_thread(embed_results, batch, embedding_client)
+            except Exception as e:
+                print(f"Error processing batch: {e}")
+                rows = []
+            await write_queue.put([row for row in rows if row['emb'] is not None])
 
-def populate_embs_from_result(result_dict, batch_size=100, max_workers=20):
+    async def write():
+        while (rows := await write_queue.get()) is not None:
+            try:
+                await asyncio.to_thread(write_fn, rows)
+                if checkpoint is not None:
+                    checkpoint.update(row['docno'] for row in rows)
+            except Exception as e:
+                print(f"Error inserting into DB: {e}")
+            if pbar is not None:
+                pbar.update(1)
+
+    async def embed_all():
+        await asyncio.gather(*(embed() for _ in range(max_concurrency)))
+        await write_queue.put(None)
+
+    await asyncio.gather(read(), embed_all(), write())
+
+def run_async(coro):
+    """Runs a coroutine to completion, also from inside a running event loop such as Jupyter's."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+def populate_embs_from_result(result_dict, batch_size=1000, embedding_client=None, max_concurrency=8,
+                              checkpoint_path=None, compact=False, requests_per_minute=3000,
+                              tokens_per_minute=1_000_000):
 
 
     # Setup your database session (modify the connection string as needed)
-    session_emb = setup_engine_session_alt(
-        db_vals['USER'],
-        db_vals['PASSWORD'],
-        db_vals['ADDRESS'],
-        db_vals['PORT'],
-        db_vals['DB_EMBS'],
-        Base=Base
+    session_emb = setup_emb_session()
+
+    # the limits apply to the default client, a client passed in brings its own rate limiter
+    embedding_client = embedding_client or get_embedding_client(
+        requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute
     )
+    if checkpoint_path is None:
+        checkpoint_path = EMBEDDING_COMPACT_CHECKPOINT_PATH if compact else EMBEDDING_CHECKPOINT_PATH
+    checkpoint = EmbeddingCheckpoint(checkpoint_path)
 
-    avail_ids = set([res[0] for res in session_emb.query(Embedding.docno).all()])
+    if checkpoint.exists():
+        avail_ids = checkpoint.done()
+    else:
+        # first run: seed the checkpoint with what is already stored, later runs only read the checkpoint.
+        # Docnos missing from it, e.g. written by another path, are embedded again but not stored twice.
+        model = CompactEmbedding if compact else Embedding
+        avail_ids = set([res[0] for res in session_emb.query(model.docno).all()])
+        checkpoint.update(avail_ids)
 
     result_dict = [res for res in result_dict if res['docno'] not in avail_ids]
     print(f"{len(avail_ids)} Tables already processed")
@@ -290,42 +996,26 @@ def populate_embs_from_result(result_dict, batch_size=100, max_workers=20):
     
     total_batches = (len(result_dict) + batch_size - 1) // batch_size  # Ceiling division
 
-    # Overall progress bar for batches
     with tqdm(total=total_batches, desc="Overall Progress") as overall_pbar:
-        # Iterate over each batch
-        for batch in batch_iterator(result_dict, batch_size):
-            embeddings = []
-
-            # Inner progress bar for processing items in the current batch
-            with ProcessPoolExecutor(max_workers=max_workers) as executor:
-                # Submit all tasks for the current batch
-                futures = {executor.submit(process_res, res): res for res in batch}
-
-                # As each future completes, append the result
-                for future in tqdm(as_completed(futures), total=len(futures), desc="Batch Processing", leave=False):
-                    try:
-                        result = future.result()
-                        embeddings.append(result)
-                    except Exception as e:
-                        print(f"Error processing item: {e}")
-
-            # Insert the processed embeddings into the database
-            try:
-                embeddings_to_db(embeddings, session_emb)
-            except Exception as e:
-                print(f"Error inserting into DB: {e}")
-
-            # Update the overall progress bar
-            overall_pbar.update(1)
+        run_async(embedding_pipeline(
+            result_dict,
+            lambda rows: copy_embeddings_to_db(rows, session_emb, compact=compact),
+            embedding_client,
+            batch_size=batch_size,
+            max_concurrency=max_concurrency,
+            checkpoint=checkpoint,
+            pbar=overall_pbar,
+        ))
 
     # Close the session after all batches are processed
     session_emb.close()
+    if embedding_client.cache is not None:
+        print(f"Embedding cache: {embedding_client.cache.stats()}")
     print("Processing and insertion complete.")
 
 
-def get_emb_df():
-
-    session_emb = setup_engine_session_alt(
+def setup_emb_session():
+    return setup_engine_session_alt(
         db_vals['USER'],
         db_vals['PASSWORD'],
         db_vals['ADDRESS'],
@@ -333,7 +1023,83 @@ def get_emb_df():
         db_vals['DB_EMBS'],
         Base=Base
     )
-    
-    all_embs = session_emb.query(Embedding).all()
-    all_embs = [{'docno' : row.docno, 'embedding' : row.embedding} for row in all_embs]
-    return pd.DataFrame(all_embs)
\ No newline at end of file
+
+def _load_emb_snapshot(snapshot_path, docnos=None):
+    all_docnos = np.load(os.path.join(snapshot_path, "docnos.npy"))
+    matrix = np.load(os.path.join(snapshot_path, "embeddings.npy"), mmap_mode="r")
+    if docnos is None:
+        return all_docnos, matrix
+    mask = np.isin(all_docnos, np.asarray(list(docnos), dtype=str))
+    return all_docnos[mask], np.asarray(matrix[mask])
+
+def _save_emb_snapshot(snapshot_path, docnos, matrix):
+    os.makedirs(snapshot_path, exist_ok=True)
+    for name, array in (("docnos.npy", docnos), ("embeddings.npy", matrix)):
+        tmp_path = os.path.join(snapshot_path, f".{name}")
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, os.path.join(snapshot_path, name))
+
+def load_emb_matrix(compact=False, docnos=None, snapshot_path=None, refresh=False, itersize=10_000):
+    """
+    Loads stored embeddings as one float32 matrix.
+
+    Rows are streamed through a named server-side cursor straight into a preallocated matrix, so no ORM
+    objects or intermediate lists are built and peak memory stays close to the size of the matrix.
+
+    Args:
+        compact (bool, optional): Read the float32 `embedding_compact` table instead of the array table.
+                                  Defaults to False.
+        docnos (iterable, optional): Only load these docnos. Defaults to None (load all).
+        snapshot_path (str, optional): Directory of an `.npy` snapshot. It is read (memory-mapped) instead
+                                       of the database if present and written after a full database load.
+                                       Defaults to None.
+        refresh (bool, optional): Ignore an existing snapshot and reload from the database. Defaults to False.
+        itersize (int, optional): Rows fetched per round trip. Defaults to 10000.
+
+    Returns:
+        tuple: (docnos, matrix) with a docno array and a float32 matrix of shape (rows, dim).
+    """
+    if snapshot_path and not refresh and os.path.exists(os.path.join(snapshot_path, "embeddings.npy")):
+        return _load_emb_snapshot(snapshot_path, docnos)
+
+    table = "embedding_compact" if compact else "embedding"
+    dim_expr = "dim" if compact else "array_length(embedding, 1)"
+    where, params = ("WHERE docno = ANY(%s)", [list(docnos)]) if docnos is not None else ("", [])
+
+    session_emb = setup_emb_session()
+    conn = session_emb.connection().connection
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT count(*), max({dim_expr}) FROM {table} {where}", params)
+        n_rows, dim = cursor.fetchone()
+
+    matrix = np.empty((n_rows, dim or 0), dtype=np.float32)
+    loaded_docnos = []
+    with conn.cursor(name="emb_stream") as cursor:
+        cursor.itersize = itersize
+        cursor.execute(f"SELECT docno, embedding FROM {table} {where} ORDER BY id", params)
+        for i, (docno, emb) in enumerate(cursor):
+            if i == n_rows:
+                break
+            loaded_docnos.append(docno)
+            matrix[i] = np.frombuffer(emb, dtype='<f4') if compact else emb
+    session_emb.close()
+
+    loaded_docnos = np.array(loaded_docnos, dtype=str)
+    matrix = matrix[:len(loaded_docnos)]
+    if snapshot_path and docnos is None:
+        _save_emb_snapshot(snapshot_path, loaded_docnos, matrix)
+    return loaded_docnos, matrix
+
+def migrate_embeddings_to_compact(batch_size=10_000):
+    """Copies the double precision `embedding` table into `embedding_compact`."""
+    docnos, matrix = load_emb_matrix(compact=False)
+    session_emb = setup_emb_session()
+    for i in tqdm(range(0, len(docnos), batch_size), desc="Migrating embeddings"):
+        rows = [{'docno': docno, 'emb': emb} for docno, emb in zip(docnos[i:i + batch_size], matrix[i:i + batch_size])]
+        copy_embeddings_to_db(rows, session_emb, compact=True)
+    session_emb.close()
+
+def get_emb_df(compact=False, docnos=None, snapshot_path=None):
+    docnos, matrix = load_emb_matrix(compact=compact, docnos=docnos, snapshot_path=snapshot_path)
+    return pd.DataFrame({'docno': docnos, 'embedding': list(matrix)})
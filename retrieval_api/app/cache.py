@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, List, Optional, Union
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def index_fingerprint(paths: Union[str, List[str]]) -> str:
+    """Hash over name, size and modification time of every file of one or more index directories."""
+    entries = []
+    for path in [paths] if isinstance(paths, str) else paths:
+        path = os.path.realpath(path)
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                entries.append(f"{os.path.join(root, name)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha1("\n".join(sorted(entries)).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Bounded query-result cache with LRU and TTL eviction.
+
+    Entries live in an in-memory LRU. With `path` they are also written to a SQLite file, so several
+    uvicorn workers on one host share their results. Every key is scoped by the fingerprint of the
+    index at `index_path`, taken once when the cache is created. Create the cache right after loading
+    the index, so keys always describe the index that is actually served. Workers that load a rebuilt
+    index never read entries of the old one, and those entries expire with their TTL.
+
+    Args:
+        max_items (int, optional): Capacity of the in-memory LRU. Defaults to 1024.
+        ttl (float, optional): Seconds an entry stays valid. Defaults to 3600.
+        path (str, optional): SQLite file shared between workers. Defaults to None (memory only).
+        index_path (str or list, optional): Directories of the loaded indexes. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        max_items: int = 1024,
+        ttl: float = 3600,
+        path: Optional[str] = None,
+        index_path: Optional[Union[str, List[str]]] = None,
+    ) -> None:
+        self.max_items = max_items
+        self.ttl = ttl
+        self.index_path = index_path
+        self._memory = OrderedDict()
+        self._fingerprint = index_fingerprint(index_path) if index_path else ""
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        if path:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS result_cache (key TEXT PRIMARY KEY, expires REAL, value TEXT)"
+            )
+            self._conn.commit()
+
+    def key(self, *parts: Any) -> str:
+        return hashlib.sha1(json.dumps([self._fingerprint, *parts]).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None and entry[0] > now:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if self._conn is not None:
+            try:
+                row = self._conn.execute("SELECT expires, value FROM result_cache WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error:
+                # e.g. "database is locked" by another worker, the result is simply computed again
+                row = None
+            if row is not None and row[0] > now:
+                value = json.loads(row[1])
+                self._remember(key, row[0], value)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: Any) -> None:
+        """Stores a JSON-serializable value."""
+        expires = time.time() + self.ttl
+        self._remember(key, expires, value)
+        if self._conn is not None:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO result_cache VALUES (?, ?, ?)", (key, expires, json.dumps(value))
+                )
+                self._conn.execute("DELETE FROM result_cache WHERE expires <= ?", (time.time(),))
+                self._conn.commit()
+            except sqlite3.Error:
+                # the result is already computed and kept in memory, only sharing it with other workers is skipped
+                self._conn.rollback()
+
+    def _remember(self, key: str, expires: float, value: Any) -> None:
+        self._memory[key] = (expires, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def clear(self) -> None:
+        self._memory.clear()
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM result_cache")
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "items": len(self._memory),
+            "max_items": self.max_items,
+        }
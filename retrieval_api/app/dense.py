@@ -0,0 +1,96 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+
+def load_dense_index(path: str, mmap: bool = True) -> Tuple["faiss.Index", np.ndarray]:
+    """
+    Loads an index directory written by `retrieval_utils.save_index` (index.faiss + docnos.npy).
+
+    Mirror of `retrieval_utils.load_index`: the API image only ships this directory and cannot import the
+    retrieval package. Keep both in sync with the on-disk format of `save_index` when it changes.
+    """
+    index_path = os.path.join(path, "index.faiss")
+    if mmap:
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        try:
+            index = faiss.read_index(index_path, flags | getattr(faiss, "IO_FLAG_MMAP_IFC", 0))
+        except RuntimeError:
+            # IVF inverted lists only support IO_FLAG_MMAP
+            index = faiss.read_index(index_path, flags)
+    else:
+        index = faiss.read_index(index_path)
+    docnos = np.load(os.path.join(path, "docnos.npy"), mmap_mode="r" if mmap else None)
+    return index, docnos
+
+
+def table_to_doc(table_docno: str) -> str:
+    """Maps a table docno (`<ir_id>_<page>_<n>`) to the docno of its document."""
+    return table_docno.rsplit("_", 2)[0]
+
+
+def collapse_to_docs(docnos: List[str], scores: List[float], k: int) -> Tuple[List[str], List[float]]:
+    """Turns a table ranking into a document ranking, scoring every document by its best table."""
+    seen = set()
+    doc_docnos, doc_scores = [], []
+    for docno, score in zip(docnos, scores):
+        doc = table_to_doc(docno)
+        if doc in seen:
+            continue
+        seen.add(doc)
+        doc_docnos.append(doc)
+        doc_scores.append(score)
+        if len(doc_docnos) == k:
+            break
+    return doc_docnos, doc_scores
+
+
+def rrf_fuse(runs: List[List[str]], k: int = 60, depth: Optional[int] = None) -> Tuple[List[str], List[float]]:
+    """Reciprocal Rank Fusion of ranked docno lists, ranks starting at 0 like the offline runs."""
+    scores: Dict[str, float] = {}
+    for run in runs:
+        for rank, docno in enumerate(run):
+            scores[docno] = scores.get(docno, 0.0) + 1.0 / (rank + k)
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:depth]
+    return [docno for docno, _ in fused], [score for _, score in fused]
+
+
+class QueryEncoder:
+    """
+    Embeds query texts with the OpenAI embeddings endpoint behind an in-memory LRU.
+
+    Args:
+        client: Object exposing `embeddings.create(input=..., model=...)` like `openai.OpenAI`.
+        model (str, optional): Embedding model, must match the one the index was built with.
+        max_items (int, optional): Capacity of the LRU. Defaults to 4096.
+    """
+
+    def __init__(self, client, model: str = "text-embedding-3-small", max_items: int = 4096) -> None:
+        self.client = client
+        self.model = model
+        self.max_items = max_items
+        self._cache = OrderedDict()
+        # encode runs in several threadpool threads, the request itself is made outside the lock
+        self._lock = threading.Lock()
+
+    def encode(self, queries: List[str]) -> np.ndarray:
+        """Returns a float32 matrix with one row per query; uncached queries are embedded in one request."""
+        keys = [" ".join(query.split()) for query in queries]
+        with self._lock:
+            found = {key: self._cache[key] for key in keys if key in self._cache}
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        if missing:
+            response = self.client.embeddings.create(input=missing, model=self.model)
+            for row in response.data:
+                found[missing[row.index]] = np.asarray(row.embedding, dtype=np.float32)
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                self._cache[key] = found[key]
+                self._cache.move_to_end(key)
+            while len(self._cache) > self.max_items:
+                self._cache.popitem(last=False)
+        return np.stack([found[key] for key in keys])
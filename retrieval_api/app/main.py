@@ -1,59 +1,485 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, field_validator
 import pyterrier as pt
-from typing import Union
+from typing import List, Literal, Optional, Tuple, Union
+import orjson
 import uvicorn
+import os
 import sys
+import asyncio
+import pandas as pd
+from collections import Counter, defaultdict
+from contextlib import asynccontextmanager
 from dotenv import dotenv_values
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from starlette.concurrency import run_in_threadpool
+
+from openai import OpenAI
 
 from model import Document, Table
+from cache import ResultCache, normalize_query
+from dense import QueryEncoder, collapse_to_docs, load_dense_index, rrf_fuse
+from table_index import TABLE_INDEX_PATH, TABLE_META
+from metrics import metrics_response, observe_request, record_cache, record_result_size, stage
 
 sys.path.append("/app/")
 
-app = FastAPI()
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        with stage("serialize"):
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global ready
+    if search_model is None:
+        # JVM start and index loading block, keep the event loop free meanwhile
+        await run_in_threadpool(init)
+    await warmup()
+    # an unreachable database must not stop the process, /readyz reports 503 until the pool is up
+    db_retry = None
+    if await warmup_db():
+        ready = True
+    else:
+        db_retry = asyncio.create_task(wait_for_db())
+    yield
+    ready = False
+    if db_retry is not None:
+        db_retry.cancel()
+    if engine is not None:
+        await engine.dispose()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+try:
+    from brotli_asgi import BrotliMiddleware
+
+    # falls back to gzip for clients that do not accept brotli
+    app.add_middleware(BrotliMiddleware, minimum_size=1000)
+except ImportError:
+    app.add_middleware(GZipMiddleware, minimum_size=1000)
+
+
+@app.middleware("http")
+async def timing(request: Request, call_next):
+    return await observe_request(request, call_next, server_timing)
+
 index = None
 search_model = None
-session = None
+engine = None
+session_factory = None
+result_cache = ResultCache()
+dense_index = None
+dense_docnos = None
+query_encoder = None
+table_search_model = None
+ready = False
+server_timing = False
 
 INDEX_PATH = "/app/cord19_table_index"
+DENSE_INDEX_PATH = "/app/cord19_table_faiss"
+DENSE_OVERFETCH = 4  # tables fetched per requested document, several tables can belong to one document
+RRF_K = 60
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 20
+RESULT_CACHE_SIZE = 1024
+RESULT_CACHE_TTL = 3600
+DOC_FIELDS = ("rank", "docno", "docid", "score")
+TABLE_FIELDS = tuple(column.name for column in Table.__table__.columns)
+DEFAULT_DOC_FIELDS = "rank,docno,score"
+DEFAULT_TABLE_FIELDS = "ir_tab_id,table_name,caption"
+MAX_DOC_LIMIT = 1000
+MAX_TABLE_LIMIT = 100
+WARMUP_QUERIES = ("covid 19", "patient characteristics", "vaccine efficacy", "mortality rate")
+DB_RETRY_INTERVAL = 5
+Mode = Literal["bm25", "dense", "hybrid"]
 
 def init():
     global index
     global search_model
-    global session
+    global engine
+    global session_factory
+    global result_cache
+    global dense_index
+    global dense_docnos
+    global query_encoder
+    global table_search_model
+    global server_timing
     
     if not pt.started():
         pt.init()
+    db_vals = dotenv_values("/app/.env")
+    # loads the index structures into memory instead of reading them from disk on every query,
+    # with several workers this keeps one private copy per worker instead of sharing the page cache
+    preload = (db_vals.get('INDEX_PRELOAD') or "false").lower() in ("1", "true", "yes")
+    server_timing = (db_vals.get('SERVER_TIMING') or "false").lower() in ("1", "true", "yes")
     print("load retrieval model")
 
-    index  = pt.IndexFactory.of(INDEX_PATH)
+    index = pt.IndexFactory.of(INDEX_PATH, memory=preload)
     search_model = pt.BatchRetrieve(index, wmodel="BM25")
-    db_vals = dotenv_values("/app/.env")
 
-    engine = create_engine(f"postgresql+psycopg2://{db_vals['USER']}:{db_vals['PASSWORD']}@{db_vals['ADDRESS']}:{db_vals['PORT']}/{db_vals['DB']}", echo=False)
-    session = Session(engine)
+    # resolve the version symlink once, so the loaded index and the cache fingerprint describe the same build
+    table_index_path = os.path.realpath(db_vals.get('TABLE_INDEX_PATH') or TABLE_INDEX_PATH)
+    if os.path.exists(table_index_path):
+        print("load table retrieval model")
+        table_search_model = pt.BatchRetrieve(
+            pt.IndexFactory.of(table_index_path, memory=preload), wmodel="BM25", metadata=list(TABLE_META)
+        )
+
+    engine = create_async_engine(
+        f"postgresql+asyncpg://{db_vals['USER']}:{db_vals['PASSWORD']}@{db_vals['ADDRESS']}:{db_vals['PORT']}/{db_vals['DB']}",
+        pool_size=int(db_vals.get('DB_POOL_SIZE') or DB_POOL_SIZE),
+        max_overflow=int(db_vals.get('DB_MAX_OVERFLOW') or DB_MAX_OVERFLOW),
+        pool_pre_ping=True,
+        echo=False,
+    )
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+
+    dense_path = db_vals.get('DENSE_INDEX_PATH') or DENSE_INDEX_PATH
+    if os.path.exists(dense_path):
+        print("load dense index")
+        dense_index, dense_docnos = load_dense_index(dense_path, mmap=not preload)
+        query_encoder = QueryEncoder(
+            OpenAI(api_key=db_vals.get('OPENAI_API_KEY')),
+            model=db_vals.get('EMBEDDING_MODEL') or "text-embedding-3-small",
+        )
+
+    # created after all indexes are loaded, the key fingerprint describes exactly the indexes being served
+    result_cache = ResultCache(
+        max_items=int(db_vals.get('RESULT_CACHE_SIZE') or RESULT_CACHE_SIZE),
+        ttl=float(db_vals.get('RESULT_CACHE_TTL') or RESULT_CACHE_TTL),
+        path=db_vals.get('RESULT_CACHE_PATH'),
+        index_path=[INDEX_PATH, table_index_path, dense_path],
+    )
+
 
+async def warmup(queries: Tuple[str, ...] = WARMUP_QUERIES):
+    """
+    Runs a few queries through the loaded models, so the first requests after a deploy do not pay
+    for JIT compilation and page faults.
+    """
+    for query in queries:
+        await run_in_threadpool(search_model.search, query)
+        if table_search_model is not None:
+            await run_in_threadpool(table_search_model.search, query)
+
+
+async def warmup_db() -> bool:
+    """Opens the pooled DB connections, returns whether the database answered."""
+
+    async def ping():
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+
+    try:
+        # concurrent pings make the pool open `pool_size` connections instead of reusing one
+        await asyncio.gather(*(ping() for _ in range(getattr(engine.pool, "size", lambda: 1)())))
+    except Exception as e:
+        print(f"database warm-up failed: {e}")
+        return False
+    return True
+
+
+async def wait_for_db(interval: float = DB_RETRY_INTERVAL):
+    """Retries the DB warm-up in the background and marks the service ready once it succeeds."""
+    global ready
+    while not await warmup_db():
+        await asyncio.sleep(interval)
+    ready = True
+
+
+async def get_session():
+    """Yields one pooled session per request."""
+    async with session_factory() as session:
+        yield session
+
+
+async def retrieve(query: str, k: int = 1000) -> pd.DataFrame:
+    # the Terrier search blocks on the JVM, keep it off the event loop
+    with stage("retrieve"):
+        res = await run_in_threadpool(search_model.search, query)
+    return res[res["rank"] < k]
+
+def parse_fields(fields: str, allowed: tuple) -> List[str]:
+    selected = list(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+    unknown = [field for field in selected if field not in allowed]
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Unknown fields {unknown}, choose from {list(allowed)}")
+    return selected
+
+def dense_search(queries: List[str], k: int) -> List[Tuple[List[str], List[float]]]:
+    """Document rankings of several queries from one FAISS search over the table index."""
+    if dense_index is None:
+        raise HTTPException(status_code=503, detail="No dense index loaded")
+    D, I = dense_index.search(query_encoder.encode(queries), k * DENSE_OVERFETCH)
+    runs = []
+    for scores, ids in zip(D, I):
+        ids, scores = ids[ids >= 0], scores[ids >= 0]
+        runs.append(collapse_to_docs(dense_docnos[ids].tolist(), scores.tolist(), k))
+    return runs
+
+async def ranked_docs(query: str, k: int, mode: str = "bm25") -> dict:
+    """Cached run of a query as columns, the position in each column is the rank."""
+    key = result_cache.key("docs", mode, normalize_query(query), k)
+    run = result_cache.get(key)
+    record_cache("docs", run is not None)
+    if run is not None:
+        return run
+
+    if mode == "bm25":
+        res = await retrieve(query, k)
+        run = {column: res[column].tolist() for column in ("docno", "docid", "score")}
+    else:
+        with stage("retrieve"):
+            docnos, scores = (await run_in_threadpool(dense_search, [query], k))[0]
+        if mode == "hybrid":
+            res = await retrieve(query, k)
+            docnos, scores = rrf_fuse([res["docno"].tolist(), docnos], k=RRF_K, depth=k)
+        run = {"docno": docnos, "docid": [None] * len(docnos), "score": scores}
+    result_cache.set(key, run)
+    return run
 
 @app.get("/issue_docs/{query}")
-def issue_docs(query: str):
-    global search_model
-    res = search_model.search(query)
-    return {"query": query, "result": res.to_dict()}
+async def issue_docs(
+    query: str,
+    k: int = Query(1000, ge=1, le=MAX_DOC_LIMIT),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_DOC_LIMIT),
+    fields: str = DEFAULT_DOC_FIELDS,
+    mode: Mode = "bm25",
+):
+    selected = parse_fields(fields, DOC_FIELDS)
+    run = await ranked_docs(query, k, mode)
+    page = range(offset, min(offset + limit, len(run["docno"])))
+    result = [{field: rank if field == "rank" else run[field][rank] for field in selected} for rank in page]
+    record_result_size(len(result))
+    total = len(run["docno"])
+    return ORJSONResponse({"query": query, "total": total, "offset": offset, "limit": limit, "result": result})
 
 @app.get("/issue_tables/{query}")
-def issue_tables(query: str):
-    global session
-    rel_docs = issue_docs(query)['result']['docno']
-    ranked_tables = {}
+async def issue_tables(
+    query: str,
+    k: int = Query(1000, ge=1, le=MAX_DOC_LIMIT),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=MAX_TABLE_LIMIT),
+    fields: str = DEFAULT_TABLE_FIELDS,
+    mode: Mode = "bm25",
+    session: AsyncSession = Depends(get_session),
+):
+    """Tables of the ranked documents `offset` to `offset + limit`, loading only the requested columns."""
+    selected = parse_fields(fields, TABLE_FIELDS)
+    run = await ranked_docs(query, k, mode)
+    total = len(run["docno"])
+
+    key = result_cache.key("tables", mode, normalize_query(query), k, offset, limit, selected)
+    result = result_cache.get(key)
+    record_cache("tables", result is not None)
+    if result is None:
+        page = run["docno"][offset:offset + limit]
 
-    for rank, docno in rel_docs.items():
-        tables = session.query(Table).filter(Table.document_id == docno).all()
-        if tables:
-            ranked_tables[rank] = tables
+        # fetch the tables of all ranked documents in one query instead of one per document
+        tables_by_doc = defaultdict(list)
+        if page:
+            columns = [getattr(Table, field) for field in selected]
+            with stage("table_fetch"):
+                rows = await session.execute(
+                    select(Table.document_id, *columns).where(Table.document_id.in_(set(page))).order_by(Table.id)
+                )
+            for docno, *values in rows:
+                tables_by_doc[docno].append(dict(zip(selected, values)))
 
-    return {"query": query, "result" : ranked_tables}
+        result = [
+            {"rank": offset + i, "docno": docno, "tables": tables_by_doc[docno]}
+            for i, docno in enumerate(page)
+            if tables_by_doc.get(docno)
+        ]
+        result = jsonable_encoder(result)
+        result_cache.set(key, result)
+
+    record_result_size(sum(len(entry["tables"]) for entry in result))
+    return ORJSONResponse({"query": query, "total": total, "offset": offset, "limit": limit, "result": result})
+
+@app.get("/search_tables/{query}")
+async def search_tables(
+    query: str,
+    k: int = Query(1000, ge=1, le=MAX_DOC_LIMIT),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=MAX_TABLE_LIMIT),
+    fields: str = DEFAULT_TABLE_FIELDS,
+    session: AsyncSession = Depends(get_session),
+):
+    """
+    Ranks tables directly with the table-level BM25 index.
+
+    The ids come from the index metadata, all other fields are loaded from the database for the requested page only.
+    """
+    if table_search_model is None:
+        raise HTTPException(status_code=503, detail="No table index loaded")
+    selected = parse_fields(fields, TABLE_FIELDS)
+
+    key = result_cache.key("tables_direct", "BM25", normalize_query(query), k)
+    run = result_cache.get(key)
+    record_cache("tables_direct", run is not None)
+    if run is None:
+        with stage("retrieve"):
+            res = await run_in_threadpool(table_search_model.search, query)
+        res = res[res["rank"] < k]
+        run = {column: res[column].tolist() for column in ("score", *TABLE_META)}
+        result_cache.set(key, run)
+
+    page = range(offset, min(offset + limit, len(run["docno"])))
+    meta = {"ir_tab_id": "docno", "ir_id": "ir_id"}
+    result = [
+        {"rank": rank, "score": run["score"][rank], **{f: run[meta[f]][rank] for f in selected if f in meta}}
+        for rank in page
+    ]
+
+    missing = [field for field in selected if field not in meta]
+    if missing and result:
+        with stage("table_fetch"):
+            rows = await session.execute(
+                select(Table.ir_tab_id, *[getattr(Table, field) for field in missing]).where(
+                    Table.ir_tab_id.in_([run["docno"][rank] for rank in page])
+                )
+            )
+        by_id = {ir_tab_id: dict(zip(missing, values)) for ir_tab_id, *values in rows}
+        for entry, rank in zip(result, page):
+            entry.update(by_id.get(run["docno"][rank], {}))
+        result = jsonable_encoder(result)
+
+    record_result_size(len(result))
+    total = len(run["docno"])
+    return ORJSONResponse({"query": query, "total": total, "offset": offset, "limit": limit, "result": result})
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness, the process is up and serving requests."""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness, models are loaded and warmed up and the database answers."""
+    if not ready or search_model is None:
+        return ORJSONResponse({"status": "starting"}, status_code=503)
+    try:
+        async with engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+    except Exception as e:
+        return ORJSONResponse({"status": "database unavailable", "detail": str(e)}, status_code=503)
+    return {"status": "ready", "table_index": table_search_model is not None, "dense_index": dense_index is not None}
+
+
+@app.get("/metrics")
+def metrics():
+    return metrics_response()
+
+
+@app.get("/cache_stats")
+def cache_stats():
+    return result_cache.stats()
+
+class BatchQuery(BaseModel):
+    query: str
+    k: int = Field(1000, ge=1, le=MAX_DOC_LIMIT)
+    qid: Optional[str] = None
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[BatchQuery] = Field(min_length=1)
+    format: Literal["columnar", "ndjson"] = "columnar"
+    mode: Mode = "bm25"
+
+    @field_validator("queries")
+    @classmethod
+    def unique_qids(cls, queries: List[BatchQuery]) -> List[BatchQuery]:
+        # results are cut per qid, so the effective qids (explicit or the 1-based position) must be unique
+        counts = Counter(q.qid or str(i + 1) for i, q in enumerate(queries))
+        duplicates = sorted(qid for qid, n in counts.items() if n > 1)
+        if duplicates:
+            raise ValueError(f"Duplicate qids {duplicates}")
+        return queries
+
+
+def runs_to_frame(qids: List[str], runs: List[Tuple[List[str], List[float]]]) -> pd.DataFrame:
+    return pd.DataFrame({
+        "qid": [qid for qid, (docnos, _) in zip(qids, runs) for _ in docnos],
+        "docno": [docno for docnos, _ in runs for docno in docnos],
+        "rank": [rank for docnos, _ in runs for rank in range(len(docnos))],
+        "score": [score for _, scores in runs for score in scores],
+    })
+
+
+def batch_retrieve(queries: List[BatchQuery], mode: str = "bm25") -> pd.DataFrame:
+    """
+    Runs all queries at once and cuts every query's results at its own k.
+
+    BM25 goes through one `transform` call, dense through one FAISS search, hybrid fuses both per query.
+    """
+    topics = pd.DataFrame({
+        "qid": [q.qid or str(i + 1) for i, q in enumerate(queries)],
+        "query": [q.query for q in queries],
+    })
+    cutoffs = pd.Series([q.k for q in queries], index=topics["qid"])
+
+    if mode != "dense":
+        res = search_model.transform(topics)
+        res = res[res["rank"] < res["qid"].map(cutoffs)]
+        if mode == "bm25":
+            return res[["qid", "docno", "rank", "score"]]
+        bm25_runs = res.groupby("qid", sort=False)["docno"].agg(list)
+
+    dense_runs = dense_search(topics["query"].tolist(), int(cutoffs.max()))
+    runs = [(docnos[:k], scores[:k]) for (docnos, scores), k in zip(dense_runs, cutoffs)]
+    if mode == "hybrid":
+        runs = [
+            rrf_fuse([bm25_runs.get(qid, []), docnos], k=RRF_K, depth=k)
+            for qid, (docnos, _), k in zip(topics["qid"], runs, cutoffs)
+        ]
+    return runs_to_frame(topics["qid"].tolist(), runs)
+
+
+def ndjson_lines(res: pd.DataFrame):
+    for qid, group in res.groupby("qid", sort=False):
+        yield orjson.dumps({
+            "qid": qid,
+            "docno": group["docno"].tolist(),
+            "rank": group["rank"].tolist(),
+            "score": group["score"].tolist(),
+        }) + b"\n"
+
+
+@app.post("/batch_search")
+async def batch_search(request: BatchSearchRequest):
+    with stage("retrieve"):
+        res = await run_in_threadpool(batch_retrieve, request.queries, request.mode)
+    record_result_size(len(res))
+    if request.format == "ndjson":
+        return StreamingResponse(ndjson_lines(res), media_type="application/x-ndjson")
+    return ORJSONResponse({column: res[column].tolist() for column in ("qid", "docno", "rank", "score")})
 
 if __name__ == "__main__":
-    init()
-    uvicorn.run(app, host="0.0.0.0", port=8082)
\ No newline at end of file
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serves the table retrieval API.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.environ.get("WEB_CONCURRENCY", 1)),
+        help="worker processes, each runs its own JVM but shares the index files through the page cache",
+    )
+    args = parser.parse_args()
+
+    # models are loaded and warmed up by the lifespan hook of every worker
+    if args.workers > 1:
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers, app_dir="/app")
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
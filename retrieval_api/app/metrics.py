@@ -0,0 +1,97 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from fastapi import Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (0, 1, 5, 10, 20, 50, 100, 250, 500, 1000, 5000)
+
+REQUEST_SECONDS = Histogram(
+    "retrieval_request_seconds", "End-to-end request latency", ["endpoint"], buckets=LATENCY_BUCKETS
+)
+STAGE_SECONDS = Histogram(
+    "retrieval_stage_seconds", "Time spent per request stage", ["endpoint", "stage"], buckets=LATENCY_BUCKETS
+)
+REQUESTS = Counter("retrieval_requests_total", "Handled requests", ["endpoint", "status"])
+RESULT_SIZE = Histogram("retrieval_result_size", "Entries returned per request", ["endpoint"], buckets=SIZE_BUCKETS)
+CACHE_LOOKUPS = Counter("retrieval_cache_lookups_total", "Result cache lookups", ["kind", "result"])
+
+# per-request state, the dict is created by the middleware and filled by the handlers
+_request_state: ContextVar[Optional[dict]] = ContextVar("request_state", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """Adds the time spent in the block to stage `name` of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        state = _request_state.get()
+        if state is not None:
+            state["stages"][name] = state["stages"].get(name, 0.0) + time.perf_counter() - start
+
+
+def record_cache(kind: str, hit: bool) -> None:
+    CACHE_LOOKUPS.labels(kind, "hit" if hit else "miss").inc()
+
+
+def record_result_size(size: int) -> None:
+    state = _request_state.get()
+    if state is not None:
+        state["result_size"] = size
+
+
+def endpoint_label(request: Request) -> str:
+    # the route template, the raw path contains the query and would explode the label cardinality
+    route = request.scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+async def observe_request(request: Request, call_next, server_timing: bool = False) -> Response:
+    """
+    Middleware body timing a request and its stages.
+
+    Args:
+        request (Request): Incoming request.
+        call_next: Next ASGI handler.
+        server_timing (bool, optional): Adds a `Server-Timing` header with the stage durations. Defaults to False.
+
+    Returns:
+        Response: The response of the handler.
+    """
+    state = {"stages": {}, "result_size": None}
+    token = _request_state.set(state)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+    finally:
+        elapsed = time.perf_counter() - start
+        _request_state.reset(token)
+        endpoint = endpoint_label(request)
+        REQUEST_SECONDS.labels(endpoint).observe(elapsed)
+        REQUESTS.labels(endpoint, str(status)).inc()
+        for name, seconds in state["stages"].items():
+            STAGE_SECONDS.labels(endpoint, name).observe(seconds)
+        if state["result_size"] is not None:
+            RESULT_SIZE.labels(endpoint).observe(state["result_size"])
+
+    if server_timing:
+        timings = [f"{name};dur={1000 * seconds:.2f}" for name, seconds in state["stages"].items()]
+        response.headers["Server-Timing"] = ", ".join(timings + [f"total;dur={1000 * elapsed:.2f}"])
+    return response
+
+
+def metrics_response() -> Response:
+    """Prometheus exposition, aggregated over all workers if `PROMETHEUS_MULTIPROC_DIR` is set."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
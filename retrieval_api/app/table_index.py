@@ -0,0 +1,141 @@
+"""Builds the table-level Terrier index served by `/search_tables` from the `table` rows of the database.
+
+Usage: python table_index.py [--force]
+
+The index is written to a fresh versioned directory and then swapped in by replacing the
+TABLE_INDEX_PATH symlink, so running workers keep serving the old version until they restart.
+The newest `--keep` versions stay on disk (default 2: the new one and the one workers may still
+have loaded), older versions are pruned on the next rebuild.
+Nothing is rebuilt when the table rows did not change since the last build, updated rows count as changes.
+"""
+import argparse
+import glob
+import os
+import shutil
+import time
+
+import pyterrier as pt
+from dotenv import dotenv_values
+from sqlalchemy import create_engine, func, literal_column
+from sqlalchemy.orm import Session
+
+from model import Table
+
+TABLE_INDEX_PATH = "/app/cord19_table_level_index"
+TABLE_TEXT_FIELDS = ["table_name", "caption", "header", "content", "references"]
+# only the ids, as long as their String(1024) columns so they match the database, the API loads all other fields
+TABLE_META = {"docno": 1024, "ir_id": 1024}
+STAMP_FILE = ".db_stamp"
+KEEP_VERSIONS = 2
+
+
+def _flatten(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return " ".join(_flatten(v) for v in value)
+    return str(value)
+
+
+def table_documents(session: Session):
+    """Yields one Terrier document per table, streaming the rows from the database."""
+    rows = session.query(
+        Table.ir_tab_id, Table.ir_id, Table.table_name, Table.caption, Table.header, Table.content, Table.references
+    ).yield_per(1000)
+    for ir_tab_id, ir_id, table_name, caption, header, content, references in rows:
+        yield {
+            "docno": ir_tab_id,
+            "ir_id": ir_id or "",
+            "table_name": _flatten(table_name),
+            "caption": _flatten(caption),
+            "header": _flatten(header),
+            "content": _flatten(content),
+            "references": _flatten(references),
+        }
+
+
+def table_stamp(session: Session) -> str:
+    """Changes with inserts, deletes and in-place updates, every new row version gets a new Postgres xmin."""
+    count, max_id, xmin_sum = session.query(
+        func.count(Table.id), func.max(Table.id), func.sum(literal_column("xmin::text::bigint"))
+    ).one()
+    return f"{count}:{max_id}:{xmin_sum}"
+
+
+def read_stamp(path: str) -> str:
+    try:
+        with open(os.path.join(path, STAMP_FILE), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def prune_versions(path: str, keep: int = KEEP_VERSIONS) -> None:
+    """Removes all but the newest `keep` versioned directories of `path`, never the one it links to."""
+    current = os.path.realpath(path)
+    versions = [v for v in glob.glob(f"{path}-*") if v.rsplit("-", 1)[1].isdigit() and os.path.isdir(v)]
+    versions.sort(key=lambda v: int(v.rsplit("-", 1)[1]), reverse=True)
+    for version in versions[max(keep, 1):]:
+        if os.path.realpath(version) != current:
+            shutil.rmtree(version, ignore_errors=True)
+
+
+def rebuild_table_index(
+    session: Session, path: str = TABLE_INDEX_PATH, force: bool = False, keep: int = KEEP_VERSIONS
+) -> bool:
+    """
+    Rebuilds the table index if the table rows changed since the last build.
+
+    Args:
+        session (Session): Session of the table database.
+        path (str, optional): Symlink the API loads the index from. Defaults to TABLE_INDEX_PATH.
+        force (bool, optional): Rebuild even if nothing changed. Defaults to False.
+        keep (int, optional): Versions kept on disk, including the new one. Defaults to KEEP_VERSIONS.
+
+    Returns:
+        bool: Whether a new index was built.
+    """
+    stamp = table_stamp(session)
+    if not force and read_stamp(path) == stamp:
+        return False
+
+    if not pt.started():
+        pt.init()
+
+    # nanoseconds, two rebuilds within a second must not write into the version the symlink points to
+    target = f"{path}-{time.time_ns()}"
+    indexer = pt.IterDictIndexer(target, meta=TABLE_META, text_attrs=TABLE_TEXT_FIELDS, fields=True)
+    indexer.index(table_documents(session))
+    with open(os.path.join(target, STAMP_FILE), "w") as f:
+        f.write(stamp)
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        os.rename(path, f"{path}-legacy")
+    tmp_link = f"{path}.tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, path)
+
+    # workers that have not restarted yet still read the previous version, only older ones are removed
+    prune_versions(path, keep)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the table-level BM25 index from the database.")
+    parser.add_argument("--force", action="store_true", help="rebuild even if the tables did not change")
+    parser.add_argument("--path", default=TABLE_INDEX_PATH)
+    parser.add_argument("--keep", type=int, default=KEEP_VERSIONS, help="index versions kept on disk")
+    args = parser.parse_args()
+
+    db_vals = dotenv_values("/app/.env")
+    engine = create_engine(
+        f"postgresql+psycopg2://{db_vals['USER']}:{db_vals['PASSWORD']}@{db_vals['ADDRESS']}:{db_vals['PORT']}/{db_vals['DB']}",
+        echo=False,
+    )
+    with Session(engine) as session:
+        if rebuild_table_index(session, args.path, force=args.force, keep=args.keep):
+            print(f"rebuilt table index at {args.path}")
+        else:
+            print("tables unchanged, index is up to date")
@@ -0,0 +1,113 @@
+"""
+Closed-loop load test for the retrieval API.
+
+Every client thread sends its next request as soon as the previous one has returned, throughput and
+latency percentiles are reported per concurrency level, e.g.
+
+    python loadtest.py --url http://localhost:8082 --concurrency 1 4 8 16 --duration 30
+"""
+
+import argparse
+import random
+import statistics
+import threading
+import time
+import urllib.parse
+import urllib.request
+from typing import List
+
+DEFAULT_QUERIES = [
+    "covid 19 mortality rate",
+    "patient characteristics",
+    "vaccine efficacy",
+    "incubation period",
+    "icu admission risk factors",
+    "viral load sars cov 2",
+    "hydroxychloroquine clinical trial",
+    "seroprevalence antibodies",
+    "reproduction number estimate",
+    "comorbidities hypertension diabetes",
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_level(
+    url: str, endpoint: str, queries: List[str], concurrency: int, duration: float, params: str, no_cache: bool = False
+) -> dict:
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(seed: int):
+        nonlocal errors
+        rng = random.Random(seed)
+        sent = 0
+        while time.perf_counter() < deadline:
+            query = rng.choice(queries)
+            if no_cache:
+                # a term unique to this request changes the cache key, the index does not know it
+                query = f"{query} nocache{concurrency}x{seed}x{sent}"
+            sent += 1
+            query = urllib.parse.quote(query)
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(f"{url}/{endpoint}/{query}?{params}", timeout=60) as response:
+                    response.read()
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+            except Exception:
+                with lock:
+                    errors += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / wall,
+        "p50_ms": 1000 * statistics.median(latencies) if latencies else float("nan"),
+        "p95_ms": 1000 * percentile(latencies, 0.95) if latencies else float("nan"),
+        "p99_ms": 1000 * percentile(latencies, 0.99) if latencies else float("nan"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Closed-loop load test for the retrieval API.")
+    parser.add_argument("--url", default="http://localhost:8082")
+    parser.add_argument("--endpoint", default="issue_docs", choices=["issue_docs", "issue_tables", "search_tables"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--duration", type=float, default=30, help="seconds per concurrency level")
+    parser.add_argument("--queries", help="file with one query per line, defaults to a small built-in list")
+    parser.add_argument("--params", default="k=1000", help="query string appended to every request")
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="appends a unique term to every request so no result comes from the cache",
+    )
+    args = parser.parse_args()
+
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries) as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    print(f"{'conc':>5} {'requests':>9} {'errors':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for concurrency in args.concurrency:
+        r = run_level(args.url, args.endpoint, queries, concurrency, args.duration, args.params, args.no_cache)
+        print(
+            f"{r['concurrency']:>5} {r['requests']:>9} {r['errors']:>7} {r['rps']:>8.1f} "
+            f"{r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f} {r['p99_ms']:>8.1f}"
+        )
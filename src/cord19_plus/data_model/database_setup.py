@@ -3,16 +3,15 @@ import glob
 import logging
 import sys
 import os
+from collections import ChainMap
 from tqdm import tqdm
 from dotenv import dotenv_values
 from concurrent.futures import ProcessPoolExecutor
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, func, insert, select
 from sqlalchemy.orm import Session
 from cord19_plus.data_model.model import Base, Table
 from cord19_plus.data_model.helpers.caption import (
-    get_caption_for_box,
-    get_cleaned_captions,
-    get_fulltext_references,
+    CaptionIndex,
     human_sort_key,
     text_matches_pattern,
     get_table_name_from_caption
@@ -39,16 +38,30 @@ def sort_paths_by_file_size(paths):
     return sorted_paths
 
 
-def setup_engine_session(user, password, address, port, db):
-    engine = create_engine(f"postgresql+psycopg2://{user}:{password}@{address}:{port}/{db}", echo=True)
+def create_missing_indexes(engine, Base=Base):
+    """
+    Creates the indexes declared on the models that an existing table does not have yet.
+
+    create_all skips tables that already exist, so indexes added to a model later, e.g. on `table.document_id`
+    and `table.ir_tab_id`, would never reach an existing database. For the table model this issues
+    CREATE INDEX ix_table_document_id ON "table" (document_id) and the same for ir_tab_id, once.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+def setup_engine_session(user, password, address, port, db, echo=True):
+    engine = create_engine(f"postgresql+psycopg2://{user}:{password}@{address}:{port}/{db}", echo=echo)
     session = Session(engine)
     Base.metadata.create_all(engine)
+    create_missing_indexes(engine)
     return session
 
 def setup_engine_session_alt(user, password, address, port, db, Base=Base):
     engine = create_engine(f"postgresql+psycopg2://{user}:{password}@{address}:{port}/{db}", echo=True)
     session = Session(engine)
     Base.metadata.create_all(engine)
+    create_missing_indexes(engine, Base=Base)
     return session
 
 def positions_from_box(obj):
@@ -72,15 +85,17 @@ def extract_data_from_json(path_to_papermage_json, table_root_path):
         table_paths = sorted(glob.glob(f"{table_root_path}/{ir_id}*"), key=human_sort_key)
         json_extracts = [json.load(open(table_path, "r")) for table_path in table_paths]
 
-        # Table related data
+        # Table related data, captions and references are indexed once per document instead of once per table
         table_data = []
+        caption_index = CaptionIndex(current_doc)
+        t_captions = caption_index.captions_for_boxes([table.boxes[0] for table in current_doc.tables])
+        t_captions_refs = caption_index.references_batch(t_captions)
         for i, table in enumerate(current_doc.tables):
             json_extract = json_extracts[i] if i < len(json_extracts) else None
             l, t, w, h, page = positions_from_box(table)
-            t_caps_cleaned = get_cleaned_captions(current_doc)
             ir_tab_id = table_paths[i].split("/")[-1].replace(".json", "") if i < len(table_paths) else ""
-            t_caption = get_caption_for_box(box=table.boxes[0], captions=current_doc.captions, caption_ids=t_caps_cleaned["tables"])
-            t_caption_refs = get_fulltext_references(current_doc, t_caption)
+            t_caption = t_captions[i]
+            t_caption_refs = t_captions_refs[i]
             table_name = get_table_name_from_caption(t_caption)
             if text_matches_pattern(t_caption, "tables") or text_matches_pattern(table.text, "tables"):
                 table_data.append({
@@ -195,6 +210,133 @@ def create_model_objects(data, model_class, session):
     except Exception as e:
         logging.error(f"Error creating model objects: {e}")
 
+def load_author_ids(model_class, session):
+    """
+    Name -> id of the authors already in the database, the lowest id for names stored more than once.
+    """
+    Author = model_class.Author
+    rows = session.execute(select(Author.name, func.min(Author.id)).group_by(Author.name))
+    return dict(rows.all())
+
+def bulk_insert_documents(data_list, model_class, session, author_ids):
+    """
+    Inserts the extracted data of many documents with one multi-row INSERT per table type instead of ORM objects.
+
+    Publication and author ids come back through RETURNING. Authors are deduplicated by name over `author_ids` and
+    the new authors of this call; the caller merges the returned new authors into `author_ids` once committed.
+
+    Parameters:
+    - data_list (list): Outputs of extract_data_from_json, None entries are skipped.
+    - model_class: Module holding the model classes.
+    - session (Session): Session whose transaction receives the inserts.
+    - author_ids (dict): Name -> id of authors that are already committed.
+
+    Returns:
+    - new_author_ids (dict): Name -> id of the authors inserted by this call.
+    """
+    data_list = [data for data in data_list if data is not None]
+    if not data_list:
+        return {}
+    Publication, Author = model_class.Publication, model_class.Author
+
+    # one publication per document, ids drawn from the serial sequence in a single statement
+    sequence = func.pg_get_serial_sequence(Publication.__tablename__, "id")
+    publication_ids = session.execute(
+        insert(Publication)
+        .from_select(["id"], select(func.nextval(sequence)).select_from(func.generate_series(1, len(data_list))))
+        .returning(Publication.id)
+    ).scalars().all()
+
+    session.execute(insert(model_class.Document), [
+        {"doi": data['current_doi'], "title": data['title'], "publication_id": publication_id}
+        for data, publication_id in zip(data_list, publication_ids)
+    ])
+
+    names = [name for data in data_list for name in data['authors'] if name not in author_ids]
+    new_author_ids = {}
+    if names:
+        rows = session.execute(
+            insert(Author).returning(Author.id, Author.name), [{"name": name} for name in dict.fromkeys(names)]
+        )
+        new_author_ids = {name: id_ for id_, name in rows}
+    known_ids = ChainMap(new_author_ids, author_ids)
+    association_rows = [
+        {"document_doi": data['current_doi'], "author_id": author_id}
+        for data in data_list
+        for author_id in dict.fromkeys(known_ids[name] for name in data['authors'])
+    ]
+    if association_rows:
+        session.execute(insert(model_class.association_table), association_rows)
+
+    table_rows = [
+        {
+            "pm_content": table['text'],
+            "ir_tab_id": table['ir_tab_id'],
+            "ir_id": table['ir_id'],
+            "header": table['header'],
+            "content": table['content'],
+            "document_id": data['current_doi'],
+            "caption": table['caption'],
+            "table_name": table['table_name'],
+            "position_left": table['position'][0],
+            "position_top": table['position'][1],
+            "width": table['position'][2],
+            "height": table['position'][3],
+            "position_page": table['position'][4],
+            "references": table['references'],
+        }
+        for data in data_list
+        for table in data['table_data']
+    ]
+    if table_rows:
+        session.execute(insert(model_class.Table), table_rows)
+
+    figure_rows = [
+        {"document_id": data['current_doi'], "ir_id": data['current_doi'], "position_left": l, "position_top": t,
+         "width": w, "height": h, "position_page": page}
+        for data in data_list
+        for l, t, w, h, page in data['figure_data']
+    ]
+    if figure_rows:
+        session.execute(insert(model_class.Figure), figure_rows)
+
+    equation_rows = [
+        {"document_id": data['current_doi'], "position_left": l, "position_top": t,
+         "width": w, "height": h, "position_page": page}
+        for data in data_list
+        for l, t, w, h, page in data['equation_data']
+    ]
+    if equation_rows:
+        session.execute(insert(model_class.Equation), equation_rows)
+
+    return new_author_ids
+
+def commit_bulk(data_list, model_class, session, author_ids):
+    """
+    Inserts and commits one transaction of documents.
+
+    On failure the transaction is rolled back and both halves are retried on their own, down to single documents,
+    so only the documents that fail by themselves are logged and skipped.
+    """
+    data_list = [data for data in data_list if data is not None]
+    if not data_list:
+        return
+    try:
+        new_author_ids = bulk_insert_documents(data_list, model_class, session, author_ids)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        if len(data_list) == 1:
+            logging.error(f"Error inserting document {data_list[0]['current_doi']}, skipped: {e}")
+            return
+        logging.warning(f"Error committing bulk insert of {len(data_list)} documents, retrying in halves: {e}")
+        middle = len(data_list) // 2
+        commit_bulk(data_list[:middle], model_class, session, author_ids)
+        commit_bulk(data_list[middle:], model_class, session, author_ids)
+        return
+    # only committed ids may be reused by later transactions
+    author_ids.update(new_author_ids)
+
 def extract_data_wrapper(json_path):
     return extract_data_from_json(json_path, TABLE_ROOT_PATH)
 
@@ -228,6 +370,42 @@ def parallel_extract_data(json_paths, model, session, num_workers=None, batch_si
                     logging.error(f"Error committing session: {e}")
                     session.rollback()
 
+def bulk_extract_data(json_paths, model_class, session, num_workers=None, commit_every=2000, chunksize=8):
+    """
+    Bulk ingest mode of parallel_extract_data.
+
+    Extraction streams from the process pool while the main process inserts `commit_every` documents per transaction
+    with bulk_insert_documents, authors are deduplicated by name across the whole run. Paths are submitted in windows
+    of `commit_every`, the next window is extracted while the current one is inserted, so at most two windows of
+    results are held in memory when inserts fall behind.
+
+    Parameters:
+    - json_paths (list): papermage JSON files to ingest.
+    - model_class: Module holding the model classes.
+    - session (Session): Session used for all inserts, its engine should run with echo=False.
+    - num_workers (int): Extraction processes, defaults to the CPU count.
+    - commit_every (int): Documents per transaction.
+    - chunksize (int): Paths handed to a worker at once.
+    """
+    author_ids = load_author_ids(model_class, session)
+    pending = []
+    with tqdm(total=len(json_paths), desc="Overall Progress") as pbar:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            windows = [json_paths[i:i + commit_every] for i in range(0, len(json_paths), commit_every)]
+            results = executor.map(extract_data_wrapper, windows[0], chunksize=chunksize) if windows else []
+            for i in range(len(windows)):
+                current = results
+                if i + 1 < len(windows):
+                    results = executor.map(extract_data_wrapper, windows[i + 1], chunksize=chunksize)
+                for data in current:
+                    if data is not None:
+                        pending.append(data)
+                    if len(pending) >= commit_every:
+                        commit_bulk(pending, model_class, session, author_ids)
+                        pending = []
+                    pbar.update(1)
+    commit_bulk(pending, model_class, session, author_ids)
+
 def main():
     # Configure logging
     logging.basicConfig(
@@ -252,7 +430,8 @@ def main():
         db_vals['PASSWORD'],
         db_vals['ADDRESS'],
         db_vals['PORT'],
-        db_vals['DB_FINAL']
+        db_vals['DB_FINAL'],
+        echo=False,
     )
 
     
@@ -265,7 +444,7 @@ def main():
 
     # Ensure 'model' is defined before passing it
     # Replace with actual model initialization if different
-    parallel_extract_data(json_paths, model, session, num_workers=10)
+    bulk_extract_data(json_paths, model, session, num_workers=10)
 
 if __name__ == "__main__":
     main()
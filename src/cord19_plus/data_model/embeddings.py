@@ -3,7 +3,7 @@ from typing import Optional
 
 from sqlalchemy.ext.declarative import declarative_base
 
-from sqlalchemy import Table, Column, Integer, String, Float, ARRAY
+from sqlalchemy import Table, Column, Integer, String, Float, ARRAY, LargeBinary
 from sqlalchemy import ForeignKey
 
 
@@ -24,5 +24,16 @@ class Embedding(Base):
 
     __tablename__ = "embedding"
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    docno: Mapped[str] = mapped_column(String(1024), nullable=False)  # String with a length of 1024
-    embedding: Mapped[List[float]] = mapped_column(ARRAY(Float), nullable=False)
\ No newline at end of file
+    # not unique, older databases may hold duplicates, the index serves the duplicate check of new writes
+    docno: Mapped[str] = mapped_column(String(1024), nullable=False, index=True)  # String with a length of 1024
+    embedding: Mapped[List[float]] = mapped_column(ARRAY(Float), nullable=False)
+
+
+class CompactEmbedding(Base):
+    """Embedding stored as raw little-endian float32 bytes instead of a double precision array."""
+
+    __tablename__ = "embedding_compact"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    docno: Mapped[str] = mapped_column(String(1024), nullable=False, unique=True)
+    dim: Mapped[int] = mapped_column(Integer, nullable=False)
+    embedding: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
@@ -1,3 +1,6 @@
+from typing import List, Optional
+
+import numpy as np
 from papermage.magelib import Box
 
 
@@ -23,3 +26,98 @@ def intersects(box1: Box, box2: Box) -> bool:
 
 def get_center(box: Box):
     return box.l + box.w / 2, box.t + box.h / 2
+
+
+class BoxIndex:
+    """
+    Per-page NumPy arrays over (l, t, w, h) of many boxes, answering `contains`, `intersects` and nearest-center
+    queries for many boxes at once. Comparisons use the same float operations as the scalar functions.
+    """
+
+    def __init__(self, boxes: List[Box]):
+        self.boxes = list(boxes)
+        coords = np.array([(box.l, box.t, box.w, box.h) for box in self.boxes], dtype=np.float64).reshape(-1, 4)
+        self.pages = np.array([box.page for box in self.boxes], dtype=np.int64)
+        self.left, self.top = coords[:, 0], coords[:, 1]
+        self.right = self.left + coords[:, 2]
+        self.bottom = self.top + coords[:, 3]
+        self.centers = np.column_stack((self.left + coords[:, 2] / 2, self.top + coords[:, 3] / 2))
+        # page -> indices of its boxes in input order
+        self.by_page = {int(page): np.flatnonzero(self.pages == page) for page in np.unique(self.pages)}
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    @classmethod
+    def from_entities(cls, entities) -> "BoxIndex":
+        """Index over the first box of every entity of a layer."""
+        return cls([ent.boxes[0] for ent in entities])
+
+    def _pairs(self, queries: "BoxIndex"):
+        """Yields (index rows, query columns) of every page both sides have boxes on."""
+        for page, cols in queries.by_page.items():
+            rows = self.by_page.get(page)
+            if rows is not None:
+                yield rows, cols
+
+    def contains(self, queries: List[Box]) -> np.ndarray:
+        """
+        Boolean matrix, entry [i, j] is `contains(boxes[i], queries[j])`.
+
+        :param queries: boxes to test
+        :return: array of shape (len(self), len(queries))
+        """
+        q = BoxIndex(queries)
+        result = np.zeros((len(self), len(q)), dtype=bool)
+        for rows, cols in self._pairs(q):
+            result[np.ix_(rows, cols)] = (
+                (self.left[rows, None] <= q.left[None, cols])
+                & (self.right[rows, None] >= q.right[None, cols])
+                & (self.top[rows, None] <= q.top[None, cols])
+                & (self.bottom[rows, None] >= q.bottom[None, cols])
+            )
+        return result
+
+    def intersects(self, queries: List[Box]) -> np.ndarray:
+        """
+        Boolean matrix, entry [i, j] is `intersects(boxes[i], queries[j])`.
+
+        :param queries: boxes to test
+        :return: array of shape (len(self), len(queries))
+        """
+        q = BoxIndex(queries)
+        result = np.zeros((len(self), len(q)), dtype=bool)
+        for rows, cols in self._pairs(q):
+            result[np.ix_(rows, cols)] = ~(
+                (self.right[rows, None] <= q.left[None, cols])
+                | (q.right[None, cols] <= self.left[rows, None])
+                | (self.bottom[rows, None] <= q.top[None, cols])
+                | (q.bottom[None, cols] <= self.top[rows, None])
+            )
+        return result
+
+    def nearest(self, queries: List[Box], k: int = 1, mask: Optional[np.ndarray] = None) -> List[np.ndarray]:
+        """
+        Indices of the k boxes on the same page whose centers are closest to the center of each query.
+
+        Ties keep the input order, so `nearest(...)[j][0]` is the box a scan with a strict `<` on
+        `math.dist(get_center(query), get_center(box))` picks.
+
+        :param queries: boxes to find neighbours for
+        :param k: number of neighbours
+        :param mask: boolean array, only boxes with True are candidates (all if None)
+        :return: per query up to k indices, nearest first, empty if no candidate is on its page
+        """
+        q = BoxIndex(queries)
+        result = [np.empty(0, dtype=np.int64) for _ in range(len(q))]
+        for rows, cols in self._pairs(q):
+            if mask is not None:
+                rows = rows[mask[rows]]
+                if not len(rows):
+                    continue
+            diff = self.centers[rows, None, :] - q.centers[None, cols, :]
+            dist = np.hypot(diff[..., 0], diff[..., 1])
+            order = np.argsort(dist, axis=0, kind="stable")[:k]
+            for j, col in enumerate(cols):
+                result[col] = rows[order[:, j]]
+        return result
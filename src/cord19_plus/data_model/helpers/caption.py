@@ -1,8 +1,10 @@
 import re
 import math
-from typing import Optional
+from typing import Optional, Tuple
 from papermage.magelib import Document, Box, Entity, Layer
-from cord19_plus.data_model.helpers.box import contains, get_center
+import numpy as np
+from cord19_plus.data_model.helpers.box import BoxIndex, contains, get_center
+from cord19_plus.data_model.helpers.caption_classifier import classify_captions, matches_layer, sort_key, table_name
 
 
 def human_sort_key(filename):
@@ -12,34 +14,20 @@ def human_sort_key(filename):
     :param filename:
     :return: tuple of numbers for custom sort with sorted()
     """
-    return [int(text) if text.isdigit() else text for text in re.split(r"(\d+)", filename)]
+    return sort_key(filename)
 
 
 def get_cleaned_captions(doc: Document) -> dict:
-
+    captions = [caption for page in doc.pages for caption in page.captions]
+    labels = classify_captions([caption.text for caption in captions])
     return {
-        "tables": [
-            caption.id
-            for page in doc.pages
-            for caption in page.captions
-            if text_matches_pattern(text=caption.text, layer="tables")
-        ],
-        "figures": [
-            caption.id
-            for page in doc.pages
-            for caption in page.captions
-            if text_matches_pattern(text=caption.text, layer="figures")
-        ],
+        "tables": [caption.id for caption, (label, _) in zip(captions, labels) if label == "table"],
+        "figures": [caption.id for caption, (label, _) in zip(captions, labels) if label == "figure"],
     }
 
 
 def text_matches_pattern(text: str, layer: str = None) -> bool:
-    if layer == "figures":
-        return bool(re.search(r"^(fig.?)", text, flags=re.I))
-    elif layer == "tables":
-        return bool(re.search(r"^(tab.?)", text, flags=re.I))
-    else:
-        return bool(re.search(r"^(fig.?|tab.?)", text, flags=re.I))
+    return matches_layer(text, layer)
 
 
 def caption_in_layer(page: Entity, layer: str, box: Box) -> bool:
@@ -143,7 +131,170 @@ def get_fulltext_references(doc: Document, caption: str) -> list:
 
 
 def get_table_name_from_caption(caption: str) -> str:
-    m = re.search(
-        r"(^(tab[^ \t\r\f\n]+)([-\t \r\f])([a-z]?([_.-])?[0-9]+)([_.-])?[^\s:\-\.]?([a-z])?)", caption, flags=re.I
-    )
-    return m.group(0).rstrip(".:-") if m else None
+    return table_name(caption)
+
+
+def compile_names_pattern(names: list) -> Tuple[re.Pattern, dict]:
+    """
+    One regex finding all `names` at once, plus the names contained in each name.
+
+    The lookahead tests every position, longer names are tried first. A shorter name starting at the same position
+    is then covered by `contained`, so the result equals `name in text` for every name.
+
+    :param names: table names
+    :return: compiled pattern and dict name -> names it contains (itself included)
+    """
+    names = sorted(set(names), key=len, reverse=True)
+    pattern = re.compile("(?=(" + "|".join(re.escape(name) for name in names) + "))")
+    contained = {name: [other for other in names if other in name] for name in names}
+    return pattern, contained
+
+
+def find_names(text: str, pattern: re.Pattern, contained: dict) -> set:
+    return {name for m in pattern.finditer(text) for name in contained[m.group(1)]}
+
+
+def get_fulltext_references_batch(doc: Document, captions: list) -> list:
+    """
+    `get_fulltext_references` for all captions of a document in one pass over blocks and sentences.
+
+    :param doc: papermage Document
+    :param captions: captions to look for in the full text
+    :return: list of references per caption, same as `[get_fulltext_references(doc, c) for c in captions]`
+    """
+    return CaptionIndex(doc).references_batch(captions)
+
+
+class CaptionIndex:
+    """
+    Caption and reference lookups of one Document, built once and shared by all of its tables.
+
+    Gives the same results as `get_caption_for_box(box, doc.captions, get_cleaned_captions(doc)["tables"])` and
+    `get_fulltext_references(doc, caption)`, without rescanning all captions, blocks and sentences per table.
+    """
+
+    def __init__(self, doc: Document):
+        self.doc = doc
+        self.cleaned_captions = get_cleaned_captions(doc)
+        self.table_caption_ids = set(self.cleaned_captions["tables"])
+
+        # spatial index over all captions, ties keep the first caption in layer order as before
+        self.captions = list(doc.captions)
+        self.caption_boxes = BoxIndex.from_entities(self.captions)
+        self.table_caption_mask = np.array([cap.id in self.table_caption_ids for cap in self.captions], dtype=bool)
+
+        # table name -> indices of blocks / sentences containing it, filled per name on first use
+        self.blocks_by_name = {}
+        self.sentences_by_name = {}
+        self._free_blocks = {}
+        self._free_sentences = {}
+        self._references = {}
+
+    def caption_for_box(self, box: Box) -> str:
+        """
+        Closest table caption on the page of the box, any caption if the document has no table captions.
+
+        :param box: box of the table
+        :return: caption text, empty if there is no caption on the page
+        """
+        return self.captions_for_boxes([box])[0]
+
+    def captions_for_boxes(self, boxes: list) -> list:
+        """
+        `caption_for_box` for many boxes with one vectorized nearest-center query.
+
+        :param boxes: boxes of the tables
+        :return: caption text per box
+        """
+        mask = self.table_caption_mask if self.table_caption_ids else None
+        nearest = self.caption_boxes.nearest(boxes, k=1, mask=mask)
+        return [self.captions[ids[0]].text if len(ids) else "" for ids in nearest]
+
+    def _block_is_free(self, i: int) -> bool:
+        # spatial queries are the expensive part, run them at most once per block and only for blocks naming a table
+        if i not in self._free_blocks:
+            self._free_blocks[i] = not self.doc.blocks[i].intersect_by_box("captions")
+        return self._free_blocks[i]
+
+    def _sentence_is_free(self, i: int) -> bool:
+        if i not in self._free_sentences:
+            sentence = self.doc.sentences[i]
+            self._free_sentences[i] = not (sentence.intersect_by_box("captions") or sentence.intersect_by_box("blocks"))
+        return self._free_sentences[i]
+
+    def _index_names(self, names: list, entities: Layer, is_free, by_name: dict) -> None:
+        """Adds the indices of the free `entities` containing each of `names` to `by_name`, in one pass."""
+        names = [name for name in dict.fromkeys(names) if name and name not in by_name]
+        if not names:
+            return
+        for name in names:
+            by_name[name] = []
+        pattern, contained = compile_names_pattern(names)
+        for i, ent in enumerate(entities):
+            found = find_names(ent.text, pattern, contained)
+            if found and is_free(i):
+                for name in found:
+                    by_name[name].append(i)
+
+    def blocks_with(self, table: str) -> list:
+        self._index_names([table], self.doc.blocks, self._block_is_free, self.blocks_by_name)
+        return self.blocks_by_name[table]
+
+    def sentences_with(self, table: str) -> list:
+        self._index_names([table], self.doc.sentences, self._sentence_is_free, self.sentences_by_name)
+        return self.sentences_by_name[table]
+
+    def references_batch(self, captions: list) -> list:
+        """
+        References of several captions, scanning blocks and sentences once for all their table names.
+
+        :param captions: captions to look for in the full text
+        :return: list of references per caption
+        """
+        names = [get_table_name_from_caption(caption) for caption in captions]
+        self._index_names(names, self.doc.blocks, self._block_is_free, self.blocks_by_name)
+        # sentences are only the fallback for tables not named in any block
+        without_blocks = [name for name in names if name and not self.blocks_by_name[name]]
+        self._index_names(without_blocks, self.doc.sentences, self._sentence_is_free, self.sentences_by_name)
+        return [self.references(caption) for caption in captions]
+
+    def references(self, caption: str) -> list:
+        """
+        Same as `get_fulltext_references(doc, caption)`, memoized per caption.
+
+        :param caption: caption to look for in the full text
+        :return: context surrounding caption
+        """
+        if caption not in self._references:
+            self._references[caption] = self._find_references(caption)
+        return list(self._references[caption])
+
+    def _find_references(self, caption: str) -> list:
+        table = get_table_name_from_caption(caption)
+        if not table:
+            return []
+
+        refs = [self.doc.blocks[i].text[:500] for i in self.blocks_with(table)]
+        if refs:
+            return refs
+
+        sentences = self.doc.sentences
+        i_sent = []
+        for i in self.sentences_with(table):
+            s = max(0, i - 1)
+            e = i + 1
+            caption = caption.replace(table, "", 1)
+            try:
+                if caption[2:35] not in sentences[s].text:
+                    i_sent.append(s)
+                if caption[2:35] not in sentences[e].text:
+                    i_sent.append(e)
+                if caption[2:35] not in sentences[i].text:
+                    i_sent.append(i)
+            except IndexError:
+                pass
+
+        for start, end in get_consecutive_ranges(i_sent):
+            ref = " ".join([sent.text[:120] for sent in sentences[max(0, start): end + 1]])
+            refs.append(ref[:360])
+        return refs
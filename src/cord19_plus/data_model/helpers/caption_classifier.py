@@ -0,0 +1,60 @@
+import re
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+FIGURE_PATTERN = re.compile(r"^(fig.?)", flags=re.I)
+TABLE_PATTERN = re.compile(r"^(tab.?)", flags=re.I)
+CAPTION_PATTERN = re.compile(r"^(fig.?|tab.?)", flags=re.I)
+# one match decides between figure and table, group 1 is set for figures, group 2 for tables
+LABEL_PATTERN = re.compile(r"^(?:(fig.?)|(tab.?))", flags=re.I)
+TABLE_NAME_PATTERN = re.compile(
+    r"(^(tab[^ \t\r\f\n]+)([-\t \r\f])([a-z]?([_.-])?[0-9]+)([_.-])?[^\s:\-\.]?([a-z])?)", flags=re.I
+)
+DIGITS_PATTERN = re.compile(r"(\d+)")
+
+LAYER_PATTERNS = {"figures": FIGURE_PATTERN, "tables": TABLE_PATTERN}
+
+
+def matches_layer(text: str, layer: str = None) -> bool:
+    return LAYER_PATTERNS.get(layer, CAPTION_PATTERN).search(text) is not None
+
+
+def table_name(caption: str) -> Optional[str]:
+    m = TABLE_NAME_PATTERN.search(caption)
+    return m.group(0).rstrip(".:-") if m else None
+
+
+def classify_caption(text: str) -> Tuple[str, Optional[str]]:
+    """
+    Label of a caption and the table name for table captions.
+
+    :param text: caption text
+    :return: ("table", table name or None), ("figure", None) or ("other", None)
+    """
+    m = LABEL_PATTERN.match(text)
+    if m is None:
+        return "other", None
+    if m.group(1) is not None:
+        return "figure", None
+    return "table", table_name(text)
+
+
+def classify_captions(texts: List[str]) -> List[Tuple[str, Optional[str]]]:
+    """
+    Classifies a whole caption list in one call, see `classify_caption`.
+
+    :param texts: caption texts
+    :return: list of (label, table name) in the order of `texts`
+    """
+    return [classify_caption(text) for text in texts]
+
+
+@lru_cache(maxsize=65536)
+def sort_key(filename: str) -> tuple:
+    """
+    Memoized natural sort key, numbers compare as integers
+
+    :param filename:
+    :return: tuple of text and numbers for sorted()
+    """
+    return tuple(int(text) if text.isdigit() else text for text in DIGITS_PATTERN.split(filename))
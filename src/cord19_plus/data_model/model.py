@@ -78,7 +78,7 @@ class Table(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     ir_id: Mapped[str] = mapped_column(String(1024))
-    ir_tab_id: Mapped[str] = mapped_column(String(1024))
+    ir_tab_id: Mapped[str] = mapped_column(String(1024), index=True)
     table_name = mapped_column(String(2048), nullable=True)
 
     pm_content: Mapped[str] = mapped_column(String(2**15), nullable=True) #32768
@@ -89,7 +89,7 @@ class Table(Base):
     header: Mapped[List[str]] = mapped_column(ARRAY(String(2**15)), nullable=True)
     #content: Mapped[List[List[str]]] = mapped_column(ARRAY(String(2**15), dimensions=2), nullable=True)
     content: Mapped[List[List[str]]] = mapped_column(JSONB, nullable=True)
-    document_id: Mapped[int] = mapped_column(ForeignKey("document.doi"))
+    document_id: Mapped[int] = mapped_column(ForeignKey("document.doi"), index=True)
     document: Mapped["Document"] = relationship(back_populates="tables")
 
     position_page: Mapped[int] = mapped_column(Integer(), nullable=True) #do we want to map this to document pages?
@@ -1,6 +1,30 @@
 import pytest
-from papermage.magelib import Box
-from data_model.helpers.box import contains, intersects, get_center
+import json
+import math
+import random
+import numpy as np
+from pathlib import Path
+from papermage.magelib import Box, Document
+from data_model.helpers.box import BoxIndex, contains, intersects, get_center
+
+
+@pytest.fixture()
+def random_boxes():
+    rng = random.Random(42)
+    # coarse grid so that shared edges, equal boxes and distance ties occur
+    return [
+        Box(l=rng.randint(0, 8) / 10, t=rng.randint(0, 8) / 10, w=rng.randint(0, 4) / 10, h=rng.randint(0, 4) / 10,
+            page=rng.randint(0, 2))
+        for _ in range(150)
+    ]
+
+
+@pytest.fixture()
+def document_boxes():
+    json_resp = Path(__file__).parent.parent.resolve() / "test_data" / "papermage_document_2.json"
+    with open(json_resp, "r") as f:
+        doc = Document.from_json(json.load(f))
+    return [ent.boxes[0] for layer in ("captions", "tables", "figures", "blocks") for ent in getattr(doc, layer)]
 
 
 @pytest.mark.parametrize(
@@ -75,3 +99,53 @@ def test_intersect_fail(box1: Box, box2: Box):
 )
 def test_get_center(box, center):
     assert get_center(box) == center
+
+
+@pytest.mark.parametrize("boxes", ["random_boxes", "document_boxes"])
+def test_box_index_contains(boxes, request):
+    boxes = request.getfixturevalue(boxes)
+    result = BoxIndex(boxes).contains(boxes)
+    assert result.tolist() == [[contains(b1, b2) for b2 in boxes] for b1 in boxes]
+
+
+@pytest.mark.parametrize("boxes", ["random_boxes", "document_boxes"])
+def test_box_index_intersects(boxes, request):
+    boxes = request.getfixturevalue(boxes)
+    result = BoxIndex(boxes).intersects(boxes)
+    assert result.tolist() == [[intersects(b1, b2) for b2 in boxes] for b1 in boxes]
+
+
+@pytest.mark.parametrize("boxes", ["random_boxes", "document_boxes"])
+def test_box_index_nearest(boxes, request):
+    boxes = request.getfixturevalue(boxes)
+    candidates, queries = boxes[::2], boxes[1::2]
+    mask = [i % 3 != 0 for i in range(len(candidates))]
+    index = BoxIndex(candidates)
+    for use_mask in (False, True):
+        nearest = index.nearest(queries, k=1, mask=np.array(mask) if use_mask else None)
+        for query, ids in zip(queries, nearest):
+            closest, expected = float("inf"), None
+            for i, box in enumerate(candidates):
+                if (use_mask and not mask[i]) or box.page != query.page:
+                    continue
+                dist = math.dist(get_center(query), get_center(box))
+                if dist < closest:
+                    closest, expected = dist, i
+            assert (ids[0] if len(ids) else None) == expected
+
+
+def test_box_index_nearest_k(random_boxes):
+    query = random_boxes[0]
+    ids = BoxIndex(random_boxes).nearest([query], k=5)[0]
+    dists = [math.dist(get_center(query), get_center(random_boxes[i])) for i in ids]
+    assert len(ids) == 5 and dists == sorted(dists) and all(random_boxes[i].page == query.page for i in ids)
+
+
+def test_box_index_centers(random_boxes):
+    assert [tuple(c) for c in BoxIndex(random_boxes).centers.tolist()] == [get_center(b) for b in random_boxes]
+
+
+def test_box_index_empty():
+    index = BoxIndex([])
+    assert index.contains([Box(l=0, t=0, w=1, h=1, page=0)]).shape == (0, 1)
+    assert len(index.nearest([Box(l=0, t=0, w=1, h=1, page=0)])[0]) == 0
@@ -0,0 +1,117 @@
+import pytest
+import json
+import os
+import re
+import timeit
+from pathlib import Path
+from papermage.magelib import Document
+from data_model.helpers.caption_classifier import (
+    classify_caption,
+    classify_captions,
+    matches_layer,
+    sort_key,
+    table_name,
+)
+
+
+# inline-pattern implementations the compiled helpers replace
+def reference_text_matches_pattern(text, layer=None):
+    if layer == "figures":
+        return bool(re.search(r"^(fig.?)", text, flags=re.I))
+    elif layer == "tables":
+        return bool(re.search(r"^(tab.?)", text, flags=re.I))
+    else:
+        return bool(re.search(r"^(fig.?|tab.?)", text, flags=re.I))
+
+
+def reference_table_name(caption):
+    m = re.search(
+        r"(^(tab[^ \t\r\f\n]+)([-\t \r\f])([a-z]?([_.-])?[0-9]+)([_.-])?[^\s:\-\.]?([a-z])?)", caption, flags=re.I
+    )
+    return m.group(0).rstrip(".:-") if m else None
+
+
+def reference_sort_key(filename):
+    return [int(text) if text.isdigit() else text for text in re.split(r"(\d+)", filename)]
+
+
+def reference_classify(text):
+    if reference_text_matches_pattern(text, "tables"):
+        return "table", reference_table_name(text)
+    if reference_text_matches_pattern(text, "figures"):
+        return "figure", None
+    return "other", None
+
+
+@pytest.fixture()
+def captions():
+    texts = []
+    for name in ["papermage_document.json", "papermage_document_2.json"]:
+        with open(Path(__file__).parent.parent.resolve() / "test_data" / name, "r") as f:
+            texts += [cap.text for cap in Document.from_json(json.load(f)).captions]
+    return texts + ["Tab. 1 results", "table A-1: summary", "Figure 2", "fig", "Image 3", "", "table is empty"]
+
+
+@pytest.mark.parametrize(
+    ("text", "result"),
+    [
+        ("Table 1: klsd lalala", ("table", "Table 1")),
+        ("Tab. 1 sadadsd", ("table", "Tab. 1")),
+        ("table is klsd", ("table", None)),
+        ("Figure 100", ("figure", None)),
+        ("fig. 1a", ("figure", None)),
+        ("Bild 1", ("other", None)),
+        ("", ("other", None)),
+    ],
+)
+def test_classify_caption(text, result):
+    assert classify_caption(text) == result
+
+
+def test_classify_captions_matches_reference(captions):
+    assert classify_captions(captions) == [reference_classify(text) for text in captions]
+
+
+@pytest.mark.parametrize("layer", ["figures", "tables", None, "equations"])
+def test_matches_layer_matches_reference(captions, layer):
+    assert [matches_layer(text, layer) for text in captions] == [
+        reference_text_matches_pattern(text, layer) for text in captions
+    ]
+
+
+def test_table_name_matches_reference(captions):
+    assert [table_name(text) for text in captions] == [reference_table_name(text) for text in captions]
+
+
+def test_sort_key_matches_reference():
+    paths = [f"/data/tab_json2/8arwlhf0_{page}_{n}.json" for page in range(40, 0, -1) for n in range(3)]
+    assert sorted(paths, key=sort_key) == sorted(paths, key=reference_sort_key)
+
+
+def test_classify_captions_table_split(captions):
+    # one classification per caption gives the same split as the two pattern passes
+    labels = classify_captions(captions)
+    assert [t for t, (label, _) in zip(captions, labels) if label == "table"] == [
+        t for t in captions if reference_text_matches_pattern(t, "tables")
+    ]
+
+
+# timing comparisons, only reported, e.g. RUN_BENCHMARKS=1 pytest -s tests/cord19_plus/data_model/helpers
+benchmark = pytest.mark.skipif(not os.environ.get("RUN_BENCHMARKS"), reason="set RUN_BENCHMARKS=1 to run benchmarks")
+
+
+@benchmark
+def test_benchmark_classify_captions(captions):
+    texts = captions * 200
+    compiled = min(timeit.repeat(lambda: classify_captions(texts), number=3, repeat=3))
+    reference = min(timeit.repeat(lambda: [reference_classify(text) for text in texts], number=3, repeat=3))
+    print(f"classify {len(texts)} captions: compiled {compiled:.4f}s, reference {reference:.4f}s")
+
+
+@benchmark
+def test_benchmark_sort_key():
+    paths = [f"/data/tab_json2/8arwlhf0_{page}_{n}.json" for page in range(200) for n in range(5)]
+    sorted(paths, key=sort_key)
+    compiled = min(timeit.repeat(lambda: sorted(paths, key=sort_key), number=5, repeat=3))
+    reference = min(timeit.repeat(lambda: sorted(paths, key=reference_sort_key), number=5, repeat=3))
+    print(f"sort {len(paths)} paths: memoized {compiled:.4f}s, reference {reference:.4f}s")
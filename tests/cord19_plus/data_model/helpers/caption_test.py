@@ -10,7 +10,11 @@ from data_model.helpers.caption import (
     get_fulltext_references,
     human_sort_key,
     get_table_name_from_caption,
-    get_consecutive_ranges
+    get_consecutive_ranges,
+    CaptionIndex,
+    get_fulltext_references_batch,
+    compile_names_pattern,
+    find_names,
 )
 
 
@@ -260,3 +264,44 @@ def test_get_table_name_from_caption_fail(caption, result):
 )
 def test_get_consecutive_ranges(numbers, result):
     assert get_consecutive_ranges(numbers) == result
+
+
+@pytest.mark.parametrize("document", ["test_document", "test_document_2"])
+def test_caption_index_caption_for_box(document, request):
+    doc = request.getfixturevalue(document)
+    index = CaptionIndex(doc)
+    caption_ids = get_cleaned_captions(doc)["tables"]
+    for layer in (doc.tables, doc.figures):
+        for ent in layer:
+            box = ent.boxes[0]
+            assert index.caption_for_box(box) == get_caption_for_box(box=box, captions=doc.captions, caption_ids=caption_ids)
+
+
+@pytest.mark.parametrize("document", ["test_document", "test_document_2"])
+def test_caption_index_references(document, request):
+    doc = request.getfixturevalue(document)
+    index = CaptionIndex(doc)
+    captions = [cap.text for cap in doc.captions] + ["Table 1", "Table 2", "Table 3", "no table"]
+    for caption in captions:
+        assert index.references(caption) == get_fulltext_references(doc, caption)
+
+
+@pytest.mark.parametrize("document", ["test_document", "test_document_2"])
+def test_get_fulltext_references_batch(document, request):
+    doc = request.getfixturevalue(document)
+    captions = [cap.text for cap in doc.captions] + ["Table 1", "Table 2", "Table 3", "Table 1", "no table", ""]
+    assert get_fulltext_references_batch(doc, captions) == [get_fulltext_references(doc, c) for c in captions]
+
+
+@pytest.mark.parametrize(
+    ("text", "result"),
+    [
+        ("see Table 11 and Table A-1", {"Table 1", "Table 11", "Table A-1"}),
+        ("Table 2", {"Table 2"}),
+        ("table 1", set()),
+        ("Tables 1", set()),
+    ],
+)
+def test_find_names(text, result):
+    pattern, contained = compile_names_pattern(["Table 1", "Table 11", "Table 2", "Table A-1"])
+    assert find_names(text, pattern, contained) == result
@@ -0,0 +1,150 @@
+import pytest
+import os
+from collections import defaultdict
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+# the module creates its OpenAI client on import, no request is sent by these tests
+os.environ.setdefault("OPENAI_API_KEY", "test")
+from retrieval.retrieval_utils import (  # noqa: E402
+    EmbeddingCache,
+    EmbeddingClient,
+    apply_queries,
+    fuse_runs,
+    generate_document_pool_rrf_df,
+)
+
+RANKINGS_PATH = Path(__file__).parent.parent.parent.resolve() / "retrieval" / "rankings"
+
+
+class StubEmbeddings:
+    """Stands in for `OpenAI().embeddings`, the vector of an input is [number of tokens, first token]."""
+
+    def __init__(self):
+        self.requests = []
+
+    def create(self, input, model):
+        self.requests.append(input)
+        data = [
+            SimpleNamespace(index=i, embedding=[float(len(tokens)), float(tokens[0])]) for i, tokens in enumerate(input)
+        ]
+        # the API does not promise to return the rows in input order
+        return SimpleNamespace(data=data[::-1])
+
+
+@pytest.fixture()
+def stub():
+    return SimpleNamespace(embeddings=StubEmbeddings())
+
+
+# per-pair loop generate_document_pool_rrf_df was based on
+def reference_rrf_pool(root_path, k=60, round_decimals=4):
+    rank_pool = defaultdict(list)
+    for filename in os.listdir(root_path):
+        with open(os.path.join(root_path, filename), "r") as f:
+            for line in f:
+                qid, _, docno, rank, _, _ = line.split()
+                rank_pool[(int(qid), docno)].append(float(rank))
+    data = {"qid": [], "docno": [], "rrf_score": []}
+    for (qid, docno), ranks in rank_pool.items():
+        data["qid"].append(qid)
+        data["docno"].append(docno)
+        data["rrf_score"].append(round(sum(1.0 / (rank + k) for rank in ranks), round_decimals))
+    return pd.DataFrame(data).sort_values(by=["qid", "rrf_score"], ascending=[True, False]).reset_index(drop=True)
+
+
+def reference_apply_queries(queries, df, n=1000):
+    results = []
+    for i, query in enumerate(queries):
+        scored = df.copy()
+        scored["score"] = scored["abstract_emb"].apply(lambda x: np.dot(x, query))
+        res = scored.sort_values("score", ascending=False).head(n).copy()
+        res["qid"] = i + 1
+        res["rank"] = list(range(len(res)))
+        results.append(res)
+    return pd.concat(results)
+
+
+def write_run(path, lines):
+    with open(path, "w") as f:
+        f.writelines(f"{qid} Q0 {docno} {rank} {score} run\n" for qid, docno, rank, score in lines)
+
+
+def test_pack_respects_request_limits(stub):
+    client = EmbeddingClient(client=stub, max_batch_size=2, max_batch_tokens=10)
+    token_lists = [[1] * 4, None, [1] * 4, [1] * 4, [1] * 9, [1] * 3]
+    assert list(client.pack(token_lists)) == [[0, 2], [3], [4], [5]]
+
+
+def test_embed_batches_and_skips_short_texts(stub):
+    client = EmbeddingClient(client=stub, max_batch_size=2)
+    texts = ["table one", "abc", None, "second table", "third\ntable"]
+    embeddings = client.embed(texts)
+    assert embeddings[1] is None and embeddings[2] is None
+    # rows come back in input order although the stub reverses them
+    assert [emb[0] for emb in embeddings if emb is not None] == [
+        len(client.tokenize(text)) for text in texts if text is not None and len(text) > 3
+    ]
+    assert [len(inputs) for inputs in stub.embeddings.requests] == [2, 1]
+    assert client.n_requests == 2
+
+
+def test_embed_truncates_to_max_tokens(stub):
+    client = EmbeddingClient(client=stub, max_tokens=5)
+    assert client.embed(["word " * 50])[0][0] == 5.0
+
+
+def test_embed_reuses_cached_vectors(stub, tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embedding_cache.sqlite"))
+    first = EmbeddingClient(client=stub, cache=cache).embed(["table one", "table two"])
+    assert len(stub.embeddings.requests) == 1
+
+    # whitespace differences share a key, a new client over the same file hits without a request
+    cache.close()
+    cache = EmbeddingCache(str(tmp_path / "embedding_cache.sqlite"))
+    again = EmbeddingClient(client=stub, cache=cache).embed(["table  one", "table\ntwo", "table three"])
+    assert again[:2] == first
+    assert stub.embeddings.requests[1:] == [[EmbeddingClient(client=stub).tokenize("table three")]]
+    assert cache.stats()["disk_hits"] == 2 and cache.stats()["misses"] == 1
+    cache.close()
+
+
+def test_rrf_pool_matches_reference():
+    pool = generate_document_pool_rrf_df(str(RANKINGS_PATH))
+    reference = reference_rrf_pool(str(RANKINGS_PATH))
+    merged = reference.merge(pool, on=["qid", "docno"], suffixes=("_reference", ""))
+    assert len(pool) == len(reference) == len(merged)
+    assert (merged["rrf_score"] == merged["rrf_score_reference"]).all()
+    assert pool[["qid", "rrf_score"]].equals(reference[["qid", "rrf_score"]])
+
+
+def test_rrf_pool_rounds_like_python(tmp_path):
+    # 1/160 is 0.00625, Series.round would give 0.0062
+    write_run(tmp_path / "a.trec", [(1, "d1", 100, 1.0)])
+    assert generate_document_pool_rrf_df(str(tmp_path))["rrf_score"].tolist() == [round(1 / 160, 4)]
+
+
+def test_fuse_runs_skips_broken_file_entirely(tmp_path):
+    write_run(tmp_path / "a.trec", [(1, "d1", 0, 2.0), (1, "d2", 1, 1.0)])
+    write_run(tmp_path / "b.trec", [(1, "d1", 0, 2.0), (1, "d3", 1, 1.0)])
+    with open(tmp_path / "b.trec", "a") as f:
+        f.write("broken line\n")
+    pool = fuse_runs(str(tmp_path), chunksize=2)
+    assert pool["docno"].tolist() == ["d1", "d2"]
+
+
+def test_apply_queries_matches_reference():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {"docno": [f"doc{i}" for i in range(200)], "abstract_emb": list(rng.standard_normal((200, 16)))}
+    )
+    queries = list(rng.standard_normal((3, 16)))
+    res = apply_queries(queries, df, n=20)
+    reference = reference_apply_queries(queries, df, n=20)
+    assert res["qid"].tolist() == reference["qid"].tolist()
+    assert res["docno"].tolist() == reference["docno"].tolist()
+    assert res["rank"].tolist() == reference["rank"].tolist()
+    assert np.allclose(res["score"], reference["score"], atol=1e-5)
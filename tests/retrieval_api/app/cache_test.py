@@ -0,0 +1,81 @@
+import pytest
+import sqlite3
+import time
+
+from retrieval_api.app.cache import ResultCache, index_fingerprint, normalize_query
+
+
+@pytest.fixture()
+def index_dir(tmp_path):
+    path = tmp_path / "index"
+    path.mkdir()
+    (path / "data.properties").write_text("num.Documents=10\n")
+    return path
+
+
+def test_normalize_query():
+    assert normalize_query("  Covid\t19  Mortality ") == "covid 19 mortality"
+
+
+def test_memory_hit_and_miss():
+    cache = ResultCache()
+    key = cache.key("docs", "BM25", "covid", 1000)
+    assert cache.get(key) is None
+    cache.set(key, {"docno": ["a", "b"]})
+    assert cache.get(key) == {"docno": ["a", "b"]}
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_keys_differ_per_part():
+    cache = ResultCache()
+    assert cache.key("docs", "covid", 10) != cache.key("docs", "covid", 100)
+    assert cache.key("docs", "covid", 10) == cache.key("docs", "covid", 10)
+
+
+def test_lru_eviction():
+    cache = ResultCache(max_items=2)
+    for name in "abc":
+        cache.set(name, name)
+    assert cache.get("a") is None
+    assert cache.get("b") == "b" and cache.get("c") == "c"
+
+
+def test_ttl_expiry(monkeypatch):
+    cache = ResultCache(ttl=10)
+    cache.set("key", [1])
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 11)
+    assert cache.get("key") is None
+
+
+def test_sqlite_file_is_shared(tmp_path):
+    path = str(tmp_path / "result_cache.sqlite")
+    writer, reader = ResultCache(path=path), ResultCache(path=path)
+    writer.set(writer.key("docs", "covid"), [1, 2, 3])
+    assert reader.get(reader.key("docs", "covid")) == [1, 2, 3]
+
+
+def test_locked_sqlite_file_is_a_miss(tmp_path):
+    path = str(tmp_path / "result_cache.sqlite")
+    cache = ResultCache(path=path)
+    cache._conn.execute("PRAGMA busy_timeout = 0")
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN EXCLUSIVE")
+    try:
+        # the write is skipped, the value is still served from memory
+        cache.set("key", [1])
+        assert cache.get("key") == [1]
+    finally:
+        other.execute("COMMIT")
+        other.close()
+    assert ResultCache(path=path).get("key") is None
+
+
+def test_keys_are_scoped_by_index_fingerprint(index_dir):
+    before = ResultCache(index_path=str(index_dir))
+    assert before.key("docs", "covid") == ResultCache(index_path=str(index_dir)).key("docs", "covid")
+
+    fingerprint = index_fingerprint(str(index_dir))
+    (index_dir / "data.properties").write_text("num.Documents=11\n")
+    assert index_fingerprint(str(index_dir)) != fingerprint
+    assert ResultCache(index_path=str(index_dir)).key("docs", "covid") != before.key("docs", "covid")
@@ -0,0 +1,92 @@
+import pytest
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+from retrieval_api.app.dense import QueryEncoder, collapse_to_docs, rrf_fuse, table_to_doc
+
+
+class StubEmbeddings:
+    """Stands in for `OpenAI().embeddings`, the vector of a text is [length, number of words]."""
+
+    def __init__(self):
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def create(self, input, model):
+        with self._lock:
+            self.requests.append(list(input))
+        return SimpleNamespace(
+            data=[
+                SimpleNamespace(index=i, embedding=[float(len(text)), float(len(text.split()))])
+                for i, text in enumerate(input)
+            ]
+        )
+
+
+@pytest.fixture()
+def stub():
+    return SimpleNamespace(embeddings=StubEmbeddings())
+
+
+@pytest.mark.parametrize(
+    ("table_docno", "docno"),
+    [
+        ("8arwlhf0_3_1", "8arwlhf0"),
+        ("PMC7_12_0", "PMC7"),
+        ("a_b_c_1_2", "a_b_c"),
+    ],
+)
+def test_table_to_doc(table_docno, docno):
+    assert table_to_doc(table_docno) == docno
+
+
+def test_collapse_to_docs_keeps_best_table_per_document():
+    docnos = ["a_1_0", "b_1_0", "a_2_0", "c_1_0", "b_1_1", "d_1_0"]
+    scores = [9.0, 8.0, 7.0, 6.0, 5.0, 4.0]
+    assert collapse_to_docs(docnos, scores, k=10) == (["a", "b", "c", "d"], [9.0, 8.0, 6.0, 4.0])
+    assert collapse_to_docs(docnos, scores, k=2) == (["a", "b"], [9.0, 8.0])
+    assert collapse_to_docs([], [], k=5) == ([], [])
+
+
+def test_rrf_fuse():
+    runs = [["a", "b", "c"], ["b", "d"]]
+    docnos, scores = rrf_fuse(runs, k=60)
+    expected = {"a": 1 / 60, "b": 1 / 61 + 1 / 60, "c": 1 / 62, "d": 1 / 61}
+    assert docnos == sorted(expected, key=expected.get, reverse=True)
+    assert scores == pytest.approx([expected[docno] for docno in docnos])
+    assert rrf_fuse(runs, k=60, depth=2)[0] == docnos[:2]
+
+
+def test_query_encoder_caches_normalized_queries(stub):
+    encoder = QueryEncoder(stub)
+    vectors = encoder.encode(["covid  mortality", "vaccine", "covid mortality"])
+    assert vectors.dtype == np.float32 and vectors.shape == (3, 2)
+    assert stub.embeddings.requests == [["covid mortality", "vaccine"]]
+    assert np.array_equal(vectors[0], vectors[2])
+
+    encoder.encode(["vaccine", "covid\tmortality"])
+    assert len(stub.embeddings.requests) == 1
+
+
+def test_query_encoder_lru_is_bounded_and_thread_safe(stub):
+    # a small LRU shared by threads, evictions of other threads must not break a running encode
+    encoder = QueryEncoder(stub, max_items=4)
+    errors = []
+
+    def work(seed):
+        rng = np.random.default_rng(seed)
+        try:
+            for _ in range(200):
+                queries = [f"query {rng.integers(20)}" for _ in range(3)]
+                assert encoder.encode(queries)[:, 0].tolist() == [float(len(query)) for query in queries]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(seed,)) for seed in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(encoder._cache) <= 4